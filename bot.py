@@ -1,13 +1,27 @@
 import asyncio
+import heapq
 import json
 import logging
+import logging.handlers
 import os
-from dataclasses import dataclass, asdict
-from datetime import datetime, timedelta
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:  # optional speedup, the stdlib json module is used otherwise
+    orjson = None
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -18,6 +32,7 @@ from telegram import (
 )
 from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CommandHandler,
@@ -29,6 +44,8 @@ from telegram.ext import (
 )
 
 # Google Calendar imports
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
@@ -38,22 +55,61 @@ from google.oauth2.credentials import Credentials
 # ---------------------------
 # Configuration and constants
 # ---------------------------
-load_dotenv()
+@dataclass(frozen=True, slots=True)
+class Config:
+    bot_token: str = ""
+    timezone: str = "UTC"
+    # Public HTTPS base URL; when set, updates arrive via webhook instead of long polling
+    webhook_url: str = ""
+    webhook_port: int = 8443
+    db_file: Path = Path(__file__).with_name("storage.db")
+    # Pre-SQLite storage, imported once when storage.db is first created
+    data_file: Path = Path(__file__).with_name("storage.json")
+
+
+def load_config() -> Config:
+    load_dotenv()
+    return Config(
+        bot_token=os.getenv("TELEGRAM_BOT_TOKEN", ""),
+        timezone=os.getenv("CALENDAR_TIMEZONE", "UTC"),
+        webhook_url=os.getenv("WEBHOOK_URL", ""),
+        webhook_port=int(os.getenv("PORT", "8443")),
+    )
+
+
+# Replaced by load_config() in main(); importing the module reads no environment
+CFG = Config()
 
-BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
-CALENDAR_TIMEZONE = os.getenv("CALENDAR_TIMEZONE", "UTC")
-DATA_FILE = Path(__file__).with_name("storage.json")
 GOOGLE_TOKEN_FILE = Path(__file__).with_name("token.json")
 GOOGLE_CREDENTIALS_FILE = Path(__file__).with_name("credentials.json")
 
 # If modifying these scopes, delete the file token.json.
 GOOGLE_SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
 
+# How often the job queue refreshes the Google access token ahead of expiry
+GOOGLE_REFRESH_INTERVAL = timedelta(minutes=30)
+# Cached credentials closer than this to expiry are refreshed before use
+GOOGLE_EXPIRY_MARGIN = timedelta(minutes=5)
+# The Calendar API accepts at most 50 calls per batch request
+CALENDAR_BATCH_SIZE = 50
+
+# Telegram rejects longer messages; /list shows tasks in pages of LIST_PAGE_SIZE
+MAX_MESSAGE_LENGTH = 4096
+LIST_PAGE_SIZE = 50
+
+# Seconds to wait after a mutation before flushing to storage.db, so bursts coalesce
+FLUSH_DELAY_SECONDS = 0.5
+# How often the storage.db write-ahead log is checkpointed and truncated
+WAL_CHECKPOINT_INTERVAL = timedelta(minutes=10)
+
+# How long before a task's due time its reminder is sent
+REMINDER_LEAD = timedelta(minutes=30)
+
 
 # ---------------------------
 # Data model and persistence
 # ---------------------------
-@dataclass
+@dataclass(slots=True)
 class Task:
     id: int
     text: str
@@ -63,82 +119,363 @@ class Task:
     calendar_event_id: Optional[str] = None
 
 
-def read_user_tasks() -> Dict[str, List[Dict]]:
-    if not DATA_FILE.exists():
+_PRIORITIES = frozenset(("low", "normal", "high"))
+# Sort key for listings: most important first
+_PRIORITY_RANK = {"high": 0, "normal": 1, "low": 2}
+
+
+# In-memory task store: loaded once in main(), mutated in place by handlers and
+# persisted by flush_user_tasks_forever() shortly after it is marked dirty.
+# Shape: {chat_id: {"next_id": int, "by_id": {task_id: Task}}}
+_STORE: Dict[int, Dict] = {}
+# Held by handlers that await between reading a task and writing it back, so
+# a concurrent update cannot act on the same stale task (e.g. insert twice).
+# Per chat, so one slow Google call doesn't stall every other chat.
+_CHAT_LOCKS: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+_DIRTY = asyncio.Event()
+# Set on shutdown; the flusher writes what is pending and exits
+_STOP_FLUSHER = asyncio.Event()
+# Task ids changed since the last flush, per chat; only those rows are written
+_DIRTY_TASKS: Dict[int, Set[int]] = defaultdict(set)
+_WRITE_LOCK = threading.Lock()
+# Bumped on every mutation of a chat's tasks; keys the per-chat render caches
+_TASKS_VERSION: Dict[int, int] = {}
+
+_DB: Optional[sqlite3.Connection] = None
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    next_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    chat_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    priority TEXT NOT NULL DEFAULT 'normal',
+    done INTEGER NOT NULL DEFAULT 0,
+    due_iso TEXT,
+    calendar_event_id TEXT,
+    PRIMARY KEY (chat_id, id)
+) WITHOUT ROWID;
+"""
+
+_TASK_COLUMNS = ("id", "text", "priority", "done", "due_iso", "calendar_event_id")
+
+
+def _task_from_dict(t: Dict) -> Task:
+    return Task(
+        id=int(t["id"]),
+        text=t.get("text", ""),
+        priority=t.get("priority", "normal"),
+        done=bool(t.get("done")),
+        due_iso=t.get("due_iso"),
+        calendar_event_id=t.get("calendar_event_id"),
+    )
+
+
+def _migrate_chat_state(raw) -> Dict:
+    # Old files store a plain list of tasks per chat; JSON also turns int keys into strings
+    if isinstance(raw, list):
+        by_id = {int(t["id"]): _task_from_dict(t) for t in raw if "id" in t}
+        return {"next_id": max(by_id, default=0) + 1, "by_id": by_id}
+    by_id = {int(k): _task_from_dict(t) for k, t in raw.get("by_id", {}).items()}
+    return {"next_id": raw.get("next_id", max(by_id, default=0) + 1), "by_id": by_id}
+
+
+def _read_legacy_json() -> Dict[int, Dict]:
+    if not CFG.data_file.exists():
         return {}
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        raw = _loads(CFG.data_file.read_bytes())
     except Exception:
         return {}
+    # Chat ids are ints in memory and only become strings as JSON object keys
+    return {int(chat_id): _migrate_chat_state(state) for chat_id, state in raw.items()}
+
+
+def _loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _open_db() -> None:
+    global _DB
+    created = not CFG.db_file.exists()
+    # Shared by the flusher's worker threads; _WRITE_LOCK serializes access
+    _DB = sqlite3.connect(CFG.db_file, check_same_thread=False)
+    _DB.execute("PRAGMA journal_mode=WAL")
+    _DB.execute("PRAGMA synchronous=NORMAL")
+    _DB.executescript(_DB_SCHEMA)
+    if created:
+        legacy = _read_legacy_json()
+        if legacy:
+            _write_tasks_sync([_snapshot_tasks(legacy, chat_id, state["by_id"]) for chat_id, state in legacy.items()])
+            logging.info("Imported %d chats from %s", len(legacy), CFG.data_file)
+
+
+def _read_tasks_sync() -> Dict[int, Dict]:
+    data: Dict[int, Dict] = {}
+    for chat_id, next_id in _DB.execute("SELECT chat_id, next_id FROM chats"):
+        data[chat_id] = {"next_id": next_id, "by_id": {}}
+    cols = ", ".join(_TASK_COLUMNS)
+    for chat_id, task_id, text, priority, done, due_iso, event_id in _DB.execute(
+        f"SELECT chat_id, {cols} FROM tasks"
+    ):
+        get_chat_state(data, chat_id)["by_id"][task_id] = Task(task_id, text, priority, bool(done), due_iso, event_id)
+    return data
+
+
+def _snapshot_tasks(data: Dict[int, Dict], chat_id: int, task_ids: Iterable[int]) -> Tuple[int, int, List[Tuple]]:
+    # Taken on the event loop thread so handlers can't mutate a task mid-copy
+    state = get_chat_state(data, chat_id)
+    by_id = state["by_id"]
+    rows = [
+        (chat_id, t.id, t.text, t.priority, int(t.done), t.due_iso, t.calendar_event_id)
+        for t in map(by_id.get, task_ids)
+        if t is not None
+    ]
+    return chat_id, state["next_id"], rows
 
 
-def write_user_tasks(data: Dict[str, List[Dict]]) -> None:
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _write_tasks_sync(snapshot: List[Tuple[int, int, List[Tuple]]]) -> None:
+    # One transaction per flush; WAL keeps readers unblocked and fsyncs only at checkpoints
+    with _WRITE_LOCK, _DB:
+        for chat_id, next_id, rows in snapshot:
+            _DB.execute("INSERT OR REPLACE INTO chats (chat_id, next_id) VALUES (?, ?)", (chat_id, next_id))
+            _DB.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
 
 
-def get_next_task_id(tasks: List[Dict]) -> int:
-    if not tasks:
-        return 1
-    return max(t.get("id", 0) for t in tasks) + 1
+def _checkpoint_sync() -> None:
+    with _WRITE_LOCK:
+        _DB.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+async def flush_dirty_tasks() -> None:
+    dirty = dict(_DIRTY_TASKS)
+    _DIRTY_TASKS.clear()
+    _DIRTY.clear()
+    if not dirty:
+        return
+    snapshot = [_snapshot_tasks(_STORE, chat_id, task_ids) for chat_id, task_ids in dirty.items()]
+    try:
+        await asyncio.to_thread(_write_tasks_sync, snapshot)
+    except BaseException:
+        # Retry these tasks on the next cycle, also when cancelled mid-write
+        for chat_id, task_ids in dirty.items():
+            _DIRTY_TASKS[chat_id].update(task_ids)
+        _DIRTY.set()
+        raise
+
+
+async def checkpoint_storage(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Folds the WAL back into storage.db and truncates it, so the log can't grow unbounded
+    try:
+        await asyncio.to_thread(_checkpoint_sync)
+    except sqlite3.Error:
+        logging.exception("Failed to checkpoint %s", CFG.db_file)
+
+
+def read_user_tasks() -> Dict[int, Dict]:
+    return _STORE
+
+
+def write_user_tasks(data: Dict[int, Dict], chat_id: int, *task_ids: int) -> None:
+    _TASKS_VERSION[chat_id] = _TASKS_VERSION.get(chat_id, 0) + 1
+    _DIRTY_TASKS[chat_id].update(task_ids)
+    _DIRTY.set()
+
+
+async def flush_user_tasks_forever() -> None:
+    while not _STOP_FLUSHER.is_set():
+        await _DIRTY.wait()
+        # Let bursts coalesce, but don't hold up shutdown
+        try:
+            await asyncio.wait_for(_STOP_FLUSHER.wait(), FLUSH_DELAY_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await flush_dirty_tasks()
+        except sqlite3.Error:
+            # Keep the flusher alive and retry on the next cycle
+            logging.exception("Failed to write %s", CFG.db_file)
+
+
+def get_chat_tasks(data: Dict[int, Dict], chat_id: int) -> Dict[int, Task]:
+    state = data.get(chat_id)
+    return state["by_id"] if state else {}
+
+
+def get_chat_state(data: Dict[int, Dict], chat_id: int) -> Dict:
+    state = data.get(chat_id)
+    if state is None:
+        state = data[chat_id] = {"next_id": 1, "by_id": {}}
+    return state
+
+
+def allocate_task_id(state: Dict) -> int:
+    task_id = state["next_id"]
+    state["next_id"] = task_id + 1
+    return task_id
 
 
 # ---------------------------
 # Google Calendar helpers
 # ---------------------------
+# Process-wide credentials and Calendar client, reused across handlers
+_CREDS: Optional[Credentials] = None
+_SERVICE = None
+_SERVICE_CREDS: Optional[Credentials] = None
+
+
+def _refresh_credentials_sync(creds: Credentials) -> None:
+    creds.refresh(Request())
+    with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
+        token.write(creds.to_json())
+
+
+def _expires_within(creds: Credentials, margin: timedelta) -> bool:
+    if creds.expiry is None:
+        return False
+    # google-auth keeps expiry as naive UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now <= margin
+
+
 def get_google_credentials() -> Optional[Credentials]:
-    creds: Optional[Credentials] = None
-    if GOOGLE_TOKEN_FILE.exists():
+    global _CREDS
+    if _CREDS and not _expires_within(_CREDS, GOOGLE_EXPIRY_MARGIN):
+        return _CREDS
+    creds = _CREDS
+    if creds is None and GOOGLE_TOKEN_FILE.exists():
         creds = Credentials.from_authorized_user_file(str(GOOGLE_TOKEN_FILE), GOOGLE_SCOPES)
     # If there are no (valid) credentials available, prompt the user to log in.
-    if creds and creds.expired and creds.refresh_token:
+    if creds and _expires_within(creds, GOOGLE_EXPIRY_MARGIN) and creds.refresh_token:
         try:
-            creds.refresh(Request())
-            with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
-                token.write(creds.to_json())
+            _refresh_credentials_sync(creds)
         except Exception:
-            creds = None
+            # An early refresh may fail transiently; the token is still usable until it expires
+            if creds.expired:
+                creds = None
+    _CREDS = creds
     return creds
 
 
+async def load_google_credentials() -> Optional[Credentials]:
+    # Reading token.json and refreshing do blocking I/O, so only the cached path stays on the loop
+    if _CREDS and not _expires_within(_CREDS, GOOGLE_EXPIRY_MARGIN):
+        return _CREDS
+    return await asyncio.to_thread(get_google_credentials)
+
+
+async def refresh_google_credentials(context: ContextTypes.DEFAULT_TYPE) -> None:
+    creds = _CREDS
+    if not creds or not creds.refresh_token:
+        return
+    if not _expires_within(creds, GOOGLE_REFRESH_INTERVAL):
+        return
+    try:
+        await asyncio.to_thread(_refresh_credentials_sync, creds)
+    except Exception:
+        logging.exception("Failed to refresh Google credentials")
+
+
 def run_google_oauth_flow() -> Credentials:
+    global _CREDS
     flow = InstalledAppFlow.from_client_secrets_file(str(GOOGLE_CREDENTIALS_FILE), GOOGLE_SCOPES)
     # This starts a local server and opens the browser for the user to approve
     creds = flow.run_local_server(port=0)
     with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
         token.write(creds.to_json())
+    _CREDS = creds
     return creds
 
 
 def get_calendar_service(creds: Credentials):
-    return build("calendar", "v3", credentials=creds)
+    global _SERVICE, _SERVICE_CREDS
+    if _SERVICE is None or _SERVICE_CREDS is not creds:
+        # The bundled discovery document avoids a network fetch on build
+        _SERVICE = build("calendar", "v3", credentials=creds, cache_discovery=False, static_discovery=True)
+        _SERVICE_CREDS = creds
+    return _SERVICE
+
+
+def execute_calendar_request(request, creds: Credentials):
+    # httplib2 connections are not thread-safe, so each worker call gets its own
+    return request.execute(http=AuthorizedHttp(creds, http=httplib2.Http()))
+
+
+def build_task_event(task: Task) -> Dict:
+    start_dt = datetime.fromisoformat(task.due_iso)
+    end_dt = start_dt + timedelta(hours=1)
+    return {
+        "summary": task.text,
+        "description": f"Task #{task.id} from Telegram Task Assistant",
+        "start": {"dateTime": start_dt.isoformat(), "timeZone": CFG.timezone},
+        "end": {"dateTime": end_dt.isoformat(), "timeZone": CFG.timezone},
+    }
+
+
+async def insert_task_event(creds: Credentials, task: Task) -> Dict:
+    service = get_calendar_service(creds)
+    return await asyncio.to_thread(
+        execute_calendar_request,
+        service.events().insert(calendarId="primary", body=build_task_event(task)),
+        creds,
+    )
+
+
+def _insert_events_batch_sync(service, creds: Credentials, tasks: List[Task]) -> Dict[int, str]:
+    # One HTTP round-trip per CALENDAR_BATCH_SIZE inserts; returns task id -> event id
+    created: Dict[int, str] = {}
+
+    def on_response(request_id, response, exception) -> None:
+        if exception is not None:
+            logging.warning("Batch insert failed for task #%s: %s", request_id, exception)
+        else:
+            created[int(request_id)] = response.get("id")
+
+    for i in range(0, len(tasks), CALENDAR_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for task in tasks[i:i + CALENDAR_BATCH_SIZE]:
+            batch.add(
+                service.events().insert(calendarId="primary", body=build_task_event(task)),
+                request_id=str(task.id),
+            )
+        batch.execute(http=AuthorizedHttp(creds, http=httplib2.Http()))
+    return created
 
 
 # ---------------------------
 # Command handlers
 # ---------------------------
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_first = update.effective_user.first_name if update.effective_user else "there"
-    text = (
-        f"Hi {user_first}! I am your Task Assistant.\n\n"
-        "Commands:\n"
-        "/add <text> — add a task\n"
-        "/list — show tasks\n"
-        "/done <id> — mark task done\n"
-        "/setpriority <id> <low|normal|high> — set priority\n"
-        "/due <id> <YYYY-MM-DD [HH:MM]> — set due date\n"
-        "/calendar_auth — link Google Calendar\n"
-        "/calendar_add <id> — add task as calendar event\n"
-        "/calendar_delete <id> — delete calendar event"
-    )
-    keyboard = [
+_HELP_TEXT = (
+    "Commands:\n"
+    "/add <text> — add a task\n"
+    "/list [page] — show tasks\n"
+    "/done <id> — mark task done\n"
+    "/setpriority <id> <low|normal|high> — set priority\n"
+    "/due <id> <YYYY-MM-DD [HH:MM]> — set due date\n"
+    "/calendar_auth — link Google Calendar\n"
+    "/calendar_add <id> — add task as calendar event\n"
+    "/calendar_add_all — add all open tasks with a due date\n"
+    "/calendar_delete <id> — delete calendar event"
+)
+_START_KEYBOARD = ReplyKeyboardMarkup(
+    [
         [KeyboardButton("➕ Add task"), KeyboardButton("📋 List tasks")],
         [KeyboardButton("ℹ️ Help"), KeyboardButton("🔗 Calendar auth")],
-    ]
+    ],
+    resize_keyboard=True,
+)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_first = update.effective_user.first_name if update.effective_user else "there"
     await update.message.reply_text(
-        text,
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
+        f"Hi {user_first}! I am your Task Assistant.\n\n{_HELP_TEXT}",
+        reply_markup=_START_KEYBOARD,
     )
 
 
@@ -156,38 +493,28 @@ async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = (update.message.text or "").strip()
-    if text == BTN_LIST:
-        await list_tasks(update, context)
-        return
-    if text == BTN_ADD:
-        # Start add wizard
-        await update.message.reply_text("Начнём добавление задачи. Введите название задачи:")
-        context.user_data["new_task"] = {}
-        return
-    if text == "ℹ️ Help":
-        await start(update, context)
-        return
-    if text == BTN_CAL_AUTH:
-        await calendar_auth(update, context)
+    # A date typed after choosing a task in the inline "set due" list
+    if "set_due_task_id" in context.user_data:
+        await on_due_text_after_inline(update, context)
         return
-    if text == BTN_CAL_ADD:
-        await choose_task_for_calendar(update, context)
-        return
-    if text == BTN_CAL_EDIT:
-        await choose_task_for_calendar_edit(update, context)
+    text = (update.message.text or "").strip()
+    handler = _MENU_HANDLERS.get(text)
+    if handler:
+        await handler(update, context)
         return
-    if text == BTN_EDIT:
-        # Offer edit options via lists (priority/due/done)
-        keyboard = ReplyKeyboardMarkup(
-            [[KeyboardButton("Изменить приоритет"), KeyboardButton("Изменить дедлайн")],
-             [KeyboardButton("Отметить выполненной")],
-             [KeyboardButton("Назад к меню")]], resize_keyboard=True)
-        await update.message.reply_text("Что изменить?", reply_markup=keyboard)
     # Fallback
     await update.message.reply_text("Не понял. Используйте меню или команды /start /menu.")
 
 
+async def choose_edit_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Offer edit options via lists (priority/due/done)
+    keyboard = ReplyKeyboardMarkup(
+        [[KeyboardButton("Изменить приоритет"), KeyboardButton("Изменить дедлайн")],
+         [KeyboardButton("Отметить выполненной")],
+         [KeyboardButton("Назад к меню")]], resize_keyboard=True)
+    await update.message.reply_text("Что изменить?", reply_markup=keyboard)
+
+
 # ---------------------------
 # Conversational wizards (step-by-step)
 # ---------------------------
@@ -202,22 +529,43 @@ BTN_CAL_EDIT = "🗓 Изменить в календаре"
 BTN_CAL_AUTH = "🔗 Привязать календарь"
 
 
-def build_tasks_keyboard(tasks: List[Dict], action_prefix: str) -> InlineKeyboardMarkup:
+def build_tasks_keyboard(tasks: Iterable[Task], action_prefix: str) -> InlineKeyboardMarkup:
     buttons: List[List[InlineKeyboardButton]] = []
-    for t in tasks[:25]:  # cap to 25 to avoid very large keyboards
-        label = f"{'✅' if t.get('done') else '⬜'} #{t.get('id')} • {t.get('text')[:32]}"
+    for t in islice(tasks, 25):  # cap to 25 to avoid very large keyboards
+        label = f"{'✅' if t.done else '⬜'} #{t.id} • {t.text[:32]}"
         buttons.append([
-            InlineKeyboardButton(label, callback_data=f"{action_prefix}|{t.get('id')}")
+            InlineKeyboardButton(label, callback_data=f"{action_prefix}|{t.id}")
         ])
     return InlineKeyboardMarkup(buttons) if buttons else InlineKeyboardMarkup([[InlineKeyboardButton("Нет задач", callback_data="noop")]])
 
 
+_KEYBOARD_CACHE: Dict[Tuple[int, str], Tuple[int, InlineKeyboardMarkup]] = {}
+
+
+def get_tasks_keyboard(data: Dict[int, Dict], chat_id: int, action_prefix: str) -> InlineKeyboardMarkup:
+    version = _TASKS_VERSION.get(chat_id, 0)
+    cached = _KEYBOARD_CACHE.get((chat_id, action_prefix))
+    if cached and cached[0] == version:
+        return cached[1]
+    markup = build_tasks_keyboard(get_chat_tasks(data, chat_id).values(), action_prefix)
+    _KEYBOARD_CACHE[(chat_id, action_prefix)] = (version, markup)
+    return markup
+
+
 async def add_wizard_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Введите название задачи:")
     context.user_data["new_task"] = {}
     return ADD_TITLE
 
 
+async def add_wizard_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # "/add <text>" adds right away, a bare "/add" starts the wizard
+    if context.args:
+        await add_task(update, context)
+        return ConversationHandler.END
+    return await add_wizard_start(update, context)
+
+
 async def add_wizard_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = (update.message.text or "").strip()
     if not text:
@@ -266,181 +614,173 @@ async def add_wizard_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Create task now
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    new_id = get_next_task_id(tasks)
-    new_task = {
-        "id": new_id,
-        "text": context.user_data.get("new_task", {}).get("text", ""),
-        "priority": context.user_data.get("new_task", {}).get("priority", "normal"),
-        "done": False,
-        "due_iso": context.user_data.get("new_task", {}).get("due_iso"),
-        "calendar_event_id": None,
-    }
-    tasks.append(new_task)
-    data[chat_id] = tasks
-    write_user_tasks(data)
+    chat_id = update.effective_chat.id
+    state = get_chat_state(data, chat_id)
+    new_id = allocate_task_id(state)
+    draft = context.user_data.get("new_task", {})
+    new_task = Task(
+        id=new_id,
+        text=draft.get("text", ""),
+        priority=draft.get("priority", "normal"),
+        due_iso=draft.get("due_iso"),
+    )
+    state["by_id"][new_id] = new_task
+    write_user_tasks(data, chat_id, new_id)
+
+    reply = f"Задача создана: #{new_id} — {new_task.text} [p:{new_task.priority}]"
+    if new_task.due_iso:
+        reply += f" | due {new_task.due_iso}"
 
     # Optionally add to calendar
     if add_to_calendar:
-        try:
-            class Dummy:
-                pass
-            context.args = [str(new_id)]
-            await calendar_add(update, context)
-        except Exception:
-            pass
+        creds = await load_google_credentials()
+        if not creds:
+            reply += "\nGoogle Calendar не привязан, используйте /calendar_auth"
+        else:
+            try:
+                created = await insert_task_event(creds, new_task)
+                new_task.calendar_event_id = created.get("id")
+                write_user_tasks(data, chat_id, new_id)
+                reply += "\nСобытие добавлено в Google Calendar ✅"
+            except Exception:
+                logging.exception("Failed to create calendar event")
+                reply += "\nНе удалось добавить событие в календарь"
 
-    # Show confirmation and then list tasks
-    reply = f"Задача создана: #{new_id} — {new_task['text']} [p:{new_task['priority']}]"
-    if new_task.get("due_iso"):
-        reply += f" | due {new_task['due_iso']}"
-    await query.edit_message_text(reply)
-    # Send list
-    fake_update = update
-    await list_tasks(fake_update, context)
+    # Confirmation and the task list go out as a single edit
+    reply += "\n\n" + render_task_page(data, chat_id, 1)
+    await query.edit_message_text(reply[:MAX_MESSAGE_LENGTH])
     context.user_data.pop("new_task", None)
     return ConversationHandler.END
 
 
 # ----- Actions by selecting a task from a list -----
 async def choose_task_for_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    await update.message.reply_text("Выберите задачу для отметки как выполненной:", reply_markup=build_tasks_keyboard(tasks, "done"))
+    keyboard = get_tasks_keyboard(read_user_tasks(), update.effective_chat.id, "done")
+    await update.message.reply_text("Выберите задачу для отметки как выполненной:", reply_markup=keyboard)
 
 
 async def choose_task_for_priority(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    await update.message.reply_text("Выберите задачу для изменения приоритета:", reply_markup=build_tasks_keyboard(tasks, "prio_task"))
+    keyboard = get_tasks_keyboard(read_user_tasks(), update.effective_chat.id, "prio_task")
+    await update.message.reply_text("Выберите задачу для изменения приоритета:", reply_markup=keyboard)
 
 
 async def choose_task_for_due(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    await update.message.reply_text("Выберите задачу для установки дедлайна:", reply_markup=build_tasks_keyboard(tasks, "due_task"))
+    keyboard = get_tasks_keyboard(read_user_tasks(), update.effective_chat.id, "due_task")
+    await update.message.reply_text("Выберите задачу для установки дедлайна:", reply_markup=keyboard)
 
 
 async def choose_task_for_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    await update.message.reply_text("Выберите задачу для добавления в календарь:", reply_markup=build_tasks_keyboard(tasks, "cal_add"))
+    keyboard = get_tasks_keyboard(read_user_tasks(), update.effective_chat.id, "cal_add")
+    await update.message.reply_text("Выберите задачу для добавления в календарь:", reply_markup=keyboard)
 
 
 async def choose_task_for_calendar_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    await update.message.reply_text("Выберите задачу для изменения/удаления события в календаре:", reply_markup=build_tasks_keyboard(tasks, "cal_edit"))
+    keyboard = get_tasks_keyboard(read_user_tasks(), update.effective_chat.id, "cal_edit")
+    await update.message.reply_text("Выберите задачу для изменения/удаления события в календаре:", reply_markup=keyboard)
 
 
-async def on_inline_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _h_done(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
     query = update.callback_query
-    await query.answer()
+    try:
+        task_id = int(arg)
+    except ValueError:
+        return
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    payload = (query.data or "|").split("|", 1)
-    action = payload[0]
-    arg = payload[1] if len(payload) > 1 else ""
-
-    def find_task(task_id: int) -> Optional[Dict]:
-        for t in tasks:
-            if t.get("id") == task_id:
-                return t
-        return None
-
-    if action == "done":
-        try:
-            task_id = int(arg)
-        except ValueError:
-            return
-        t = find_task(task_id)
-        if not t:
-            await query.edit_message_text("Задача не найдена")
-            return
-        t["done"] = True
-        write_user_tasks(data)
-        await query.edit_message_text(f"Готово ✅ Задача #{task_id} отмечена выполненной")
+    chat_id = update.effective_chat.id
+    t = get_chat_tasks(data, chat_id).get(task_id)
+    if not t:
+        await query.edit_message_text("Задача не найдена")
         return
+    t.done = True
+    write_user_tasks(data, chat_id, task_id)
+    cancel_reminder(chat_id, task_id)
+    await query.edit_message_text(f"Готово ✅ Задача #{task_id} отмечена выполненной")
 
-    if action == "prio_task":
-        try:
-            task_id = int(arg)
-        except ValueError:
-            return
-        keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("low", callback_data=f"setprio|{task_id}|low"), InlineKeyboardButton("normal", callback_data=f"setprio|{task_id}|normal"), InlineKeyboardButton("high", callback_data=f"setprio|{task_id}|high")]]
-        )
-        await query.edit_message_text("Выберите новый приоритет:", reply_markup=keyboard)
-        return
 
-    if action == "setprio":
-        parts = arg.split("|")
-        try:
-            task_id = int(parts[0])
-        except Exception:
-            return
-        pr = parts[1] if len(parts) > 1 else "normal"
-        t = find_task(task_id)
-        if not t:
-            await query.edit_message_text("Задача не найдена")
-            return
-        t["priority"] = pr
-        write_user_tasks(data)
-        await query.edit_message_text(f"Приоритет обновлён: #{task_id} -> {pr}")
+async def _h_prio_task(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    try:
+        task_id = int(arg)
+    except ValueError:
         return
+    keyboard = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("low", callback_data=f"setprio|{task_id}|low"), InlineKeyboardButton("normal", callback_data=f"setprio|{task_id}|normal"), InlineKeyboardButton("high", callback_data=f"setprio|{task_id}|high")]]
+    )
+    await update.callback_query.edit_message_text("Выберите новый приоритет:", reply_markup=keyboard)
 
-    if action == "due_task":
-        try:
-            task_id = int(arg)
-        except ValueError:
-            return
-        # ask user to send a date string
-        context.user_data["set_due_task_id"] = task_id
-        await query.edit_message_text("Отправьте дату в формате YYYY-MM-DD [HH:MM]")
+
+async def _h_setprio(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    query = update.callback_query
+    task_arg, _, pr = arg.partition("|")
+    try:
+        task_id = int(task_arg)
+    except ValueError:
+        return
+    pr = pr or "normal"
+    # callback_data comes from the client, so check it like /setpriority does
+    if pr not in _PRIORITIES:
         return
+    data = read_user_tasks()
+    chat_id = update.effective_chat.id
+    t = get_chat_tasks(data, chat_id).get(task_id)
+    if not t:
+        await query.edit_message_text("Задача не найдена")
+        return
+    t.priority = pr
+    write_user_tasks(data, chat_id, task_id)
+    await query.edit_message_text(f"Приоритет обновлён: #{task_id} -> {pr}")
 
-    if action == "cal_add":
-        try:
-            task_id = int(arg)
-        except ValueError:
-            return
-        # reuse existing calendar_add logic by simulating args
-        class Dummy:
-            pass
-        context.args = [str(task_id)]
-        await calendar_add(update, context)
+
+async def _h_due_task(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    try:
+        task_id = int(arg)
+    except ValueError:
         return
+    # ask user to send a date string
+    context.user_data["set_due_task_id"] = task_id
+    await update.callback_query.edit_message_text("Отправьте дату в формате YYYY-MM-DD [HH:MM]")
 
-    if action == "cal_edit":
-        try:
-            task_id = int(arg)
-        except ValueError:
-            return
-        keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("Удалить событие", callback_data=f"caldel|{task_id}")]]
-        )
-        await query.edit_message_text("Выберите действие с событием календаря:", reply_markup=keyboard)
+
+async def _h_cal_add(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    try:
+        task_id = int(arg)
+    except ValueError:
         return
+    # reuse existing calendar_add logic by simulating args
+    context.args = [str(task_id)]
+    await calendar_add(update, context)
 
-    if action == "caldel":
-        try:
-            task_id = int(arg)
-        except ValueError:
-            return
-        context.args = [str(task_id)]
-        await calendar_delete(update, context)
+
+async def _h_cal_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    try:
+        task_id = int(arg)
+    except ValueError:
         return
+    keyboard = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Удалить событие", callback_data=f"caldel|{task_id}")]]
+    )
+    await update.callback_query.edit_message_text("Выберите действие с событием календаря:", reply_markup=keyboard)
+
 
-    # ignore other/noop
-    if action == "noop":
+async def _h_caldel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    try:
+        task_id = int(arg)
+    except ValueError:
         return
+    context.args = [str(task_id)]
+    await calendar_delete(update, context)
+
+
+async def _h_noop(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    return
+
+
+async def on_inline_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    action, _, arg = (query.data or "").partition("|")
+    handler = _INLINE_DISPATCH.get(action)
+    if handler:
+        await handler(update, context, arg)
 
 
 async def on_due_text_after_inline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -452,15 +792,15 @@ async def on_due_text_after_inline(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("Неверный формат даты. Повторите команду /due или используйте /menu → Установить дедлайн.")
         return
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    for t in tasks:
-        if t.get("id") == task_id:
-            t["due_iso"] = due_iso
-            write_user_tasks(data)
-            await update.message.reply_text(f"Дедлайн установлен для задачи #{task_id}: {due_iso}")
-            return
-    await update.message.reply_text("Задача не найдена")
+    chat_id = update.effective_chat.id
+    t = get_chat_tasks(data, chat_id).get(task_id)
+    if not t:
+        await update.message.reply_text("Задача не найдена")
+        return
+    t.due_iso = due_iso
+    write_user_tasks(data, chat_id, task_id)
+    schedule_task_reminder(chat_id, t)
+    await update.message.reply_text(f"Дедлайн установлен для задачи #{task_id}: {due_iso}")
 
 
 async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -469,32 +809,61 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     text = " ".join(context.args).strip()
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    task = Task(id=get_next_task_id(tasks), text=text)
-    tasks.append(asdict(task))
-    data[chat_id] = tasks
-    write_user_tasks(data)
-    await update.message.reply_text(f"Added task #{task.id}: {task.text}")
+    chat_id = update.effective_chat.id
+    state = get_chat_state(data, chat_id)
+    task_id = allocate_task_id(state)
+    state["by_id"][task_id] = Task(id=task_id, text=text)
+    write_user_tasks(data, chat_id, task_id)
+    await update.message.reply_text(f"Added task #{task_id}: {text}")
+
+
+def format_task_line(t: Task) -> str:
+    due = t.due_iso
+    return f"{'✅' if t.done else '⬜'} {t.id}. {t.text} [p:{t.priority}]" + (f" | due {due}" if due else "")
+
+
+def render_task_list(tasks: Iterable[Task]) -> str:
+    return "\n".join(map(format_task_line, tasks))
+
+
+_LIST_CACHE: Dict[Tuple[int, int], Tuple[int, str]] = {}
 
 
-def format_task_line(t: Dict) -> str:
-    status = "✅" if t.get("done") else "⬜"
-    pr = t.get("priority", "normal")
-    due = t.get("due_iso")
-    due_str = f" | due {due}" if due else ""
-    return f"{status} {t.get('id')}. {t.get('text')} [p:{pr}]{due_str}"
+def render_task_page(data: Dict[int, Dict], chat_id: int, page: int) -> str:
+    version = _TASKS_VERSION.get(chat_id, 0)
+    cached = _LIST_CACHE.get((chat_id, page))
+    if cached and cached[0] == version:
+        return cached[1]
+    tasks = get_chat_tasks(data, chat_id)
+    # Stable sort keeps creation order within each priority
+    ordered = sorted(tasks.values(), key=lambda t: _PRIORITY_RANK.get(t.priority, 1))
+    start = (page - 1) * LIST_PAGE_SIZE
+    text = render_task_list(ordered[start:start + LIST_PAGE_SIZE])
+    remaining = len(tasks) - start - LIST_PAGE_SIZE
+    if remaining > 0:
+        text += f"\n… and {remaining} more; use /list {page + 1}"
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+    _LIST_CACHE[(chat_id, page)] = (version, text)
+    return text
 
 
 async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
+    chat_id = update.effective_chat.id
+    tasks = get_chat_tasks(data, chat_id)
     if not tasks:
         await update.message.reply_text("No tasks yet. Add one with /add <text> ✨")
         return
-    lines = [format_task_line(t) for t in tasks]
-    await update.message.reply_text("\n".join(lines))
+    try:
+        page = max(int(context.args[0]), 1) if context.args else 1
+    except ValueError:
+        await update.message.reply_text("Usage: /list [page]")
+        return
+    if (page - 1) * LIST_PAGE_SIZE >= len(tasks):
+        await update.message.reply_text(f"No tasks on page {page}")
+        return
+    await update.message.reply_text(render_task_page(data, chat_id, page))
 
 
 async def done_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -508,15 +877,15 @@ async def done_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    for t in tasks:
-        if t.get("id") == task_id:
-            t["done"] = True
-            write_user_tasks(data)
-            await update.message.reply_text(f"Marked task #{task_id} as done ✅")
-            return
-    await update.message.reply_text("Task not found")
+    chat_id = update.effective_chat.id
+    t = get_chat_tasks(data, chat_id).get(task_id)
+    if not t:
+        await update.message.reply_text("Task not found")
+        return
+    t.done = True
+    write_user_tasks(data, chat_id, task_id)
+    cancel_reminder(chat_id, task_id)
+    await update.message.reply_text(f"Marked task #{task_id} as done ✅")
 
 
 async def set_priority(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -529,36 +898,37 @@ async def set_priority(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text("Task id must be a number")
         return
     pr = context.args[1].lower()
-    if pr not in {"low", "normal", "high"}:
+    if pr not in _PRIORITIES:
         await update.message.reply_text("Priority must be one of: low, normal, high")
         return
 
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    for t in tasks:
-        if t.get("id") == task_id:
-            t["priority"] = pr
-            write_user_tasks(data)
-            await update.message.reply_text(f"Priority set for task #{task_id} -> {pr}")
-            return
-    await update.message.reply_text("Task not found")
+    chat_id = update.effective_chat.id
+    t = get_chat_tasks(data, chat_id).get(task_id)
+    if not t:
+        await update.message.reply_text("Task not found")
+        return
+    t.priority = pr
+    write_user_tasks(data, chat_id, task_id)
+    await update.message.reply_text(f"Priority set for task #{task_id} -> {pr}")
+
+
+# YYYY-MM-DD with an optional HH:MM; non-padded fields are accepted like strptime did
+_DUE_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{1,2}))?$")
 
 
 def parse_due_datetime(parts: List[str]) -> Optional[str]:
     # Accept: YYYY-MM-DD or YYYY-MM-DD HH:MM
+    m = _DUE_RE.match(" ".join(parts[:2]))
+    if not m:
+        return None
+    year, month, day, hour, minute = m.groups()
     try:
-        if len(parts) == 1:
-            dt = datetime.strptime(parts[0], "%Y-%m-%d")
-            # Default time at 09:00
-            dt = dt.replace(hour=9, minute=0)
-        elif len(parts) >= 2:
-            dt = datetime.strptime(" ".join(parts[:2]), "%Y-%m-%d %H:%M")
-        else:
-            return None
-        return dt.isoformat()
+        # Default time at 09:00
+        dt = datetime(int(year), int(month), int(day), int(hour or 9), int(minute or 0))
     except ValueError:
         return None
+    return dt.isoformat()
 
 
 async def set_due(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -576,39 +946,79 @@ async def set_due(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    for t in tasks:
-        if t.get("id") == task_id:
-            t["due_iso"] = due_iso
-            write_user_tasks(data)
-            await update.message.reply_text(f"Due date set for task #{task_id} -> {due_iso}")
-            # schedule reminder 30 minutes before due, if in the future
-            try:
-                due_dt = datetime.fromisoformat(due_iso)
-                remind_at = due_dt - timedelta(minutes=30)
-                if remind_at > datetime.now():
-                    context.job_queue.run_once(
-                        callback=send_due_reminder,
-                        when=remind_at,
-                        chat_id=update.effective_chat.id,
-                        name=f"reminder-{chat_id}-{task_id}",
-                        data={"task_id": task_id, "text": t.get("text")},
-                    )
-            except Exception:
-                pass
-            return
-    await update.message.reply_text("Task not found")
+    chat_id = update.effective_chat.id
+    t = get_chat_tasks(data, chat_id).get(task_id)
+    if not t:
+        await update.message.reply_text("Task not found")
+        return
+    t.due_iso = due_iso
+    write_user_tasks(data, chat_id, task_id)
+    await update.message.reply_text(f"Due date set for task #{task_id} -> {due_iso}")
+    schedule_task_reminder(chat_id, t)
+
+
+# Pending reminders as a heap of (remind_at_ts, chat_id, task_id, text), drained
+# by a single background task instead of one scheduler job per reminder
+_REMINDERS: List[Tuple[float, int, int, str]] = []
+_REMINDER_WAKE = asyncio.Event()
+# Live reminder time per (chat_id, task_id); heap entries that no longer match
+# were cancelled or rescheduled and are dropped when they reach the top
+_REMINDER_DUE: Dict[Tuple[int, int], float] = {}
+
 
+def schedule_reminder(remind_at: datetime, chat_id: int, task_id: int, text: str) -> None:
+    ts = remind_at.timestamp()
+    _REMINDER_DUE[(chat_id, task_id)] = ts
+    heapq.heappush(_REMINDERS, (ts, chat_id, task_id, text))
+    _REMINDER_WAKE.set()
 
-async def send_due_reminder(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job = context.job
-    if not job:
+
+def cancel_reminder(chat_id: int, task_id: int) -> None:
+    _REMINDER_DUE.pop((chat_id, task_id), None)
+
+
+def schedule_task_reminder(chat_id: int, t: Task) -> None:
+    # Remind REMINDER_LEAD before the due time, if that is still in the future
+    if t.done:
+        return
+    try:
+        remind_at = datetime.fromisoformat(t.due_iso) - REMINDER_LEAD
+    except (TypeError, ValueError):
         return
-    data = job.data or {}
-    task_id = data.get("task_id")
-    text = data.get("text")
-    await context.bot.send_message(chat_id=job.chat_id, text=f"⏰ Reminder: task #{task_id} — {text}")
+    if remind_at > datetime.now():
+        schedule_reminder(remind_at, chat_id, t.id, t.text)
+
+
+def schedule_pending_reminders(data: Dict[int, Dict]) -> None:
+    # The heap lives in memory only, so rebuild it from stored due dates on startup
+    for chat_id, state in data.items():
+        for t in state["by_id"].values():
+            if t.due_iso and not t.done:
+                schedule_task_reminder(chat_id, t)
+
+
+async def run_reminders_forever(bot) -> None:
+    while True:
+        _REMINDER_WAKE.clear()
+        if not _REMINDERS:
+            await _REMINDER_WAKE.wait()
+            continue
+        delay = _REMINDERS[0][0] - time.time()
+        if delay > 0:
+            # Wake early if a sooner reminder gets pushed meanwhile
+            try:
+                await asyncio.wait_for(_REMINDER_WAKE.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        ts, chat_id, task_id, text = heapq.heappop(_REMINDERS)
+        if _REMINDER_DUE.get((chat_id, task_id)) != ts:
+            continue
+        del _REMINDER_DUE[(chat_id, task_id)]
+        try:
+            await bot.send_message(chat_id=chat_id, text=f"⏰ Reminder: task #{task_id} — {text}")
+        except Exception:
+            logging.exception("Failed to send reminder")
 
 
 async def calendar_auth(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -620,8 +1030,7 @@ async def calendar_auth(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text(
         "Starting Google OAuth flow. A browser window may open on the host machine."
     )
-    loop = asyncio.get_event_loop()
-    creds = await loop.run_in_executor(None, run_google_oauth_flow)
+    creds = await asyncio.to_thread(run_google_oauth_flow)
     if creds:
         await update.message.reply_text("Google Calendar linked ✅")
     else:
@@ -630,97 +1039,171 @@ async def calendar_auth(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 async def calendar_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
-        await update.message.reply_text("Usage: /calendar_add <id>")
+        await update.effective_message.reply_text("Usage: /calendar_add <id>")
         return
     try:
         task_id = int(context.args[0])
     except ValueError:
-        await update.message.reply_text("Task id must be a number")
+        await update.effective_message.reply_text("Task id must be a number")
         return
 
-    creds = get_google_credentials()
+    creds = await load_google_credentials()
     if not creds:
-        await update.message.reply_text("Please run /calendar_auth first to link your Google Calendar.")
+        await update.effective_message.reply_text("Please run /calendar_auth first to link your Google Calendar.")
         return
 
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    task = next((t for t in tasks if t.get("id") == task_id), None)
-    if not task:
-        await update.message.reply_text("Task not found")
-        return
+    chat_id = update.effective_chat.id
+    async with _CHAT_LOCKS[chat_id]:
+        data = read_user_tasks()
+        task = get_chat_tasks(data, chat_id).get(task_id)
+        if not task:
+            await update.effective_message.reply_text("Task not found")
+            return
 
-    due_iso = task.get("due_iso")
-    if not due_iso:
-        await update.message.reply_text("Set a due date first with /due <id> <YYYY-MM-DD [HH:MM]>")
+        due_iso = task.due_iso
+        if not due_iso:
+            await update.effective_message.reply_text("Set a due date first with /due <id> <YYYY-MM-DD [HH:MM]>")
+            return
+
+        try:
+            created = await insert_task_event(creds, task)
+            task.calendar_event_id = created.get("id")
+            write_user_tasks(data, chat_id, task_id)
+            html_link = created.get("htmlLink")
+            await update.effective_message.reply_text(
+                f"Event created in Google Calendar ✅\nLink: {html_link}"
+            )
+        except Exception as e:
+            logging.exception("Failed to create calendar event")
+            await update.effective_message.reply_text("Failed to create calendar event. Check logs and OAuth setup.")
+
+
+async def calendar_add_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    creds = await load_google_credentials()
+    if not creds:
+        await update.effective_message.reply_text("Please run /calendar_auth first to link your Google Calendar.")
         return
 
-    try:
-        service = get_calendar_service(creds)
-        start_dt = datetime.fromisoformat(due_iso)
-        end_dt = start_dt + timedelta(hours=1)
-        event = {
-            "summary": task.get("text"),
-            "description": f"Task #{task_id} from Telegram Task Assistant",
-            "start": {"dateTime": start_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
-            "end": {"dateTime": end_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
-        }
-        created = service.events().insert(calendarId="primary", body=event).execute()
-        task["calendar_event_id"] = created.get("id")
-        write_user_tasks(data)
-        html_link = created.get("htmlLink")
-        await update.message.reply_text(
-            f"Event created in Google Calendar ✅\nLink: {html_link}"
-        )
-    except Exception as e:
-        logging.exception("Failed to create calendar event")
-        await update.message.reply_text("Failed to create calendar event. Check logs and OAuth setup.")
+    chat_id = update.effective_chat.id
+    async with _CHAT_LOCKS[chat_id]:
+        data = read_user_tasks()
+        pending = [
+            t for t in get_chat_tasks(data, chat_id).values()
+            if t.due_iso and not t.done and not t.calendar_event_id
+        ]
+        if not pending:
+            await update.effective_message.reply_text("No open tasks with a due date left to add")
+            return
+
+        try:
+            created = await asyncio.to_thread(
+                _insert_events_batch_sync, get_calendar_service(creds), creds, pending
+            )
+        except Exception:
+            logging.exception("Failed to create calendar events")
+            await update.effective_message.reply_text("Failed to create calendar events. Check logs and OAuth setup.")
+            return
+        for t in pending:
+            if t.id in created:
+                t.calendar_event_id = created[t.id]
+        if created:
+            write_user_tasks(data, chat_id, *created)
+        failed = len(pending) - len(created)
+        reply = f"Added {len(created)} task(s) to Google Calendar ✅"
+        if failed:
+            reply += f"\n{failed} failed, see logs"
+        await update.effective_message.reply_text(reply)
 
 
 # New: delete calendar event linked to a task
 async def calendar_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
-        await update.message.reply_text("Usage: /calendar_delete <id>")
+        await update.effective_message.reply_text("Usage: /calendar_delete <id>")
         return
     try:
         task_id = int(context.args[0])
     except ValueError:
-        await update.message.reply_text("Task id must be a number")
+        await update.effective_message.reply_text("Task id must be a number")
         return
 
-    creds = get_google_credentials()
+    creds = await load_google_credentials()
     if not creds:
-        await update.message.reply_text("Please run /calendar_auth first to link your Google Calendar.")
+        await update.effective_message.reply_text("Please run /calendar_auth first to link your Google Calendar.")
         return
 
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    task = next((t for t in tasks if t.get("id") == task_id), None)
-    if not task:
-        await update.message.reply_text("Task not found")
-        return
+    chat_id = update.effective_chat.id
+    async with _CHAT_LOCKS[chat_id]:
+        data = read_user_tasks()
+        task = get_chat_tasks(data, chat_id).get(task_id)
+        if not task:
+            await update.effective_message.reply_text("Task not found")
+            return
+
+        event_id = task.calendar_event_id
+        if not event_id:
+            await update.effective_message.reply_text("No linked calendar event for this task")
+            return
+
+        try:
+            service = get_calendar_service(creds)
+            await asyncio.to_thread(
+                execute_calendar_request, service.events().delete(calendarId="primary", eventId=event_id), creds
+            )
+            task.calendar_event_id = None
+            write_user_tasks(data, chat_id, task_id)
+            await update.effective_message.reply_text(f"Calendar event for task #{task_id} deleted ✅")
+        except Exception:
+            logging.exception("Failed to delete calendar event")
+            await update.effective_message.reply_text("Failed to delete calendar event. Check logs and OAuth setup.")
+
+
+def args_or_task_list(args_handler, list_handler):
+    # "/done 3" acts right away, a bare "/done" offers the inline task list
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if context.args:
+            await args_handler(update, context)
+        else:
+            await list_handler(update, context)
+    return handler
+
+
+# callback_data action prefix -> inline button handler
+_INLINE_DISPATCH = {
+    "done": _h_done,
+    "prio_task": _h_prio_task,
+    "setprio": _h_setprio,
+    "due_task": _h_due_task,
+    "cal_add": _h_cal_add,
+    "cal_edit": _h_cal_edit,
+    "caldel": _h_caldel,
+    "noop": _h_noop,
+}
+# Derived from the dispatch table so a new action can't be left unmatched
+_INLINE_ACTION_RE = re.compile("^(?:" + "|".join(map(re.escape, _INLINE_DISPATCH)) + r")(?:\||$)")
+_BTN_ADD_RE = re.compile(f"^{re.escape(BTN_ADD)}$")
+_WIZARD_PRIORITY_RE = re.compile(r"^prio\|")
+_WIZARD_CALENDAR_RE = re.compile(r"^addcal\|")
+
+
+# Menu button / keyword text -> handler, resolved with a single dict lookup
+_MENU_HANDLERS = {
+    "Меню": show_menu,
+    "Menu": show_menu,
+    BTN_LIST: list_tasks,
+    BTN_ADD: add_wizard_start,
+    "ℹ️ Help": start,
+    BTN_CAL_AUTH: calendar_auth,
+    BTN_CAL_ADD: choose_task_for_calendar,
+    BTN_CAL_EDIT: choose_task_for_calendar_edit,
+    BTN_EDIT: choose_edit_action,
+}
 
-    event_id = task.get("calendar_event_id")
-    if not event_id:
-        await update.message.reply_text("No linked calendar event for this task")
-        return
 
-    try:
-        service = get_calendar_service(creds)
-        service.events().delete(calendarId="primary", eventId=event_id).execute()
-        task["calendar_event_id"] = None
-        write_user_tasks(data)
-        await update.message.reply_text(f"Calendar event for task #{task_id} deleted ✅")
-    except Exception:
-        logging.exception("Failed to delete calendar event")
-        await update.message.reply_text("Failed to delete calendar event. Check logs and OAuth setup.")
 # ---------------------------
 # App bootstrap
 # ---------------------------
 def build_app() -> Application:
-    if not BOT_TOKEN:
+    if not CFG.bot_token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set. See .env.example and README.")
 
     async def post_init(application: Application) -> None:
@@ -735,55 +1218,122 @@ def build_app() -> Application:
                 BotCommand("due", "Установить дедлайн (через список)"),
                 BotCommand("calendar_auth", "Привязать Google Calendar"),
                 BotCommand("calendar_add", "Добавить в календарь (через список)"),
+                BotCommand("calendar_add_all", "Добавить в календарь все задачи с дедлайном"),
                 BotCommand("calendar_delete", "Удалить событие календаря"),
             ]
         )
+        application.bot_data["flush_task"] = asyncio.create_task(flush_user_tasks_forever())
+        schedule_pending_reminders(_STORE)
+        application.bot_data["reminder_task"] = asyncio.create_task(run_reminders_forever(application.bot))
+
+    async def post_shutdown(application: Application) -> None:
+        reminder_task = application.bot_data.pop("reminder_task", None)
+        if reminder_task:
+            reminder_task.cancel()
+        flush_task = application.bot_data.pop("flush_task", None)
+        if flush_task:
+            # Cancelling could cut off a write already running in its thread
+            _STOP_FLUSHER.set()
+            _DIRTY.set()
+            try:
+                await flush_task
+            except Exception:
+                logging.exception("Task flusher failed")
+        try:
+            await flush_dirty_tasks()
+        except Exception:
+            logging.exception("Failed to flush tasks on shutdown")
+        finally:
+            with _WRITE_LOCK:
+                _DB.close()
+
+    app: Application = (
+        ApplicationBuilder()
+        .token(CFG.bot_token)
+        .concurrent_updates(32)
+        # One pooled connection per concurrent update, so handlers don't queue for the pool
+        .connection_pool_size(32)
+        .pool_timeout(10.0)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    app: Application = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
+    app.job_queue.run_repeating(refresh_google_credentials, interval=GOOGLE_REFRESH_INTERVAL)
+    app.job_queue.run_repeating(checkpoint_storage, interval=WAL_CHECKPOINT_INTERVAL)
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", start))
     app.add_handler(CommandHandler("menu", show_menu))
-    app.add_handler(CommandHandler("add", add_task))
     app.add_handler(CommandHandler("list", list_tasks))
-    app.add_handler(CommandHandler("done", done_task))
-    app.add_handler(CommandHandler("setpriority", set_priority))
-    app.add_handler(CommandHandler("due", set_due))
-    app.add_handler(CommandHandler("calendar_auth", calendar_auth))
-    app.add_handler(CommandHandler("calendar_add", calendar_add))
-    app.add_handler(CommandHandler("calendar_delete", calendar_delete))
+    app.add_handler(CommandHandler("done", args_or_task_list(done_task, choose_task_for_done)))
+    app.add_handler(CommandHandler("setpriority", args_or_task_list(set_priority, choose_task_for_priority)))
+    app.add_handler(CommandHandler("due", args_or_task_list(set_due, choose_task_for_due)))
+    # Calendar handlers wait on Google, so they must not hold up other updates
+    app.add_handler(CommandHandler("calendar_auth", calendar_auth, block=False))
+    app.add_handler(CommandHandler(
+        "calendar_add", args_or_task_list(calendar_add, choose_task_for_calendar), block=False
+    ))
+    app.add_handler(CommandHandler("calendar_add_all", calendar_add_all, block=False))
+    app.add_handler(CommandHandler("calendar_delete", calendar_delete, block=False))
     # Step-by-step conversations and inline actions
     app.add_handler(ConversationHandler(
         entry_points=[
-            CommandHandler("add", add_wizard_start),
-            MessageHandler(filters.TEXT & filters.Regex(f"^{BTN_ADD}$"), add_wizard_start),
+            CommandHandler("add", add_wizard_entry),
+            MessageHandler(filters.TEXT & filters.Regex(_BTN_ADD_RE), add_wizard_start),
         ],
         states={
             ADD_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_wizard_title)],
             ADD_DATETIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_wizard_datetime)],
-            ADD_PRIORITY: [CallbackQueryHandler(add_wizard_priority, pattern=r"^prio\|")],
-            ADD_CALENDAR: [CallbackQueryHandler(add_wizard_calendar, pattern=r"^addcal\|")],
+            ADD_PRIORITY: [CallbackQueryHandler(add_wizard_priority, pattern=_WIZARD_PRIORITY_RE)],
+            ADD_CALENDAR: [CallbackQueryHandler(add_wizard_calendar, pattern=_WIZARD_CALENDAR_RE)],
         },
         fallbacks=[],
     ))
-    app.add_handler(CommandHandler("done", choose_task_for_done))
-    app.add_handler(CommandHandler("setpriority", choose_task_for_priority))
-    app.add_handler(CommandHandler("due", choose_task_for_due))
-    app.add_handler(CommandHandler("calendar_add", choose_task_for_calendar))
-    app.add_handler(CallbackQueryHandler(on_inline_action, pattern=r"^(done|prio_task|setprio|due_task|cal_add|cal_edit|caldel)\|"))
-    # Text triggers for menu as well
-    app.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) & (filters.Regex(r"^(Меню|Menu)$")), show_menu))
+    app.add_handler(CallbackQueryHandler(on_inline_action, pattern=_INLINE_ACTION_RE))
+    # Menu buttons, menu keywords and due-date replies share one text handler
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_selection))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_due_text_after_inline))
 
     return app
 
 
+def setup_logging() -> logging.handlers.QueueListener:
+    # Handlers only enqueue records; formatting and the stderr write happen on the listener thread
+    logging.logThreads = False
+    logging.logProcesses = False
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
 def main() -> None:
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-    DATA_FILE.touch(exist_ok=True)
-    app = build_app()
-    app.run_polling()
+    global CFG
+    CFG = load_config()
+    listener = setup_logging()
+    try:
+        _open_db()
+        _STORE.update(_read_tasks_sync())
+        app = build_app()
+        if CFG.webhook_url:
+            # The token as URL path keeps the endpoint unguessable
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=CFG.webhook_port,
+                url_path=CFG.bot_token,
+                webhook_url=f"{CFG.webhook_url.rstrip('/')}/{CFG.bot_token}",
+            )
+        else:
+            app.run_polling()
+    finally:
+        # Drains queued records before exit
+        listener.stop()
 
 
 if __name__ == "__main__":
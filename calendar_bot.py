@@ -1,13 +1,25 @@
 import asyncio
 import json
 import logging
+import logging.handlers
 import os
-from dataclasses import dataclass, asdict
+import queue
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
 
 
+import httpx
+try:
+    import orjson
+except ImportError:  # optional speedup, the stdlib json module is used otherwise
+    orjson = None
 from dotenv import load_dotenv
 from telegram import (
     Update,
@@ -19,6 +31,7 @@ from telegram import (
 )
 from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CommandHandler,
@@ -31,7 +44,6 @@ from telegram.ext import (
 
 
 # Google Calendar imports
-from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -46,13 +58,21 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 CALENDAR_TIMEZONE = os.getenv("CALENDAR_TIMEZONE", "UTC")
-DATA_FILE = Path(__file__).with_name("storage.json")
+# Directory holding storage.db; mount it as a volume so the WAL files live next to it
+DATA_DIR = Path(os.getenv("DATA_DIR", str(Path(__file__).parent)))
+DB_FILE = DATA_DIR / "storage.db"
+# Pre-SQLite storage, imported once when storage.db is first created; looked up in
+# DATA_DIR first, then at its old place next to the bot (the /app/storage.json mount)
+LEGACY_DATA_FILES = (DATA_DIR / "storage.json", Path(__file__).with_name("storage.json"))
 GOOGLE_TOKEN_FILE = Path(__file__).with_name("token.json")
 GOOGLE_CREDENTIALS_FILE = Path(__file__).with_name("credentials.json")
 
 
 # If modifying these scopes, delete the file token.json.
 GOOGLE_SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+CALENDAR_EVENTS_URL = "https://www.googleapis.com/calendar/v3/calendars/primary/events"
+# Inserts in flight at once during a bulk sync; they share one HTTP/2 connection
+CALENDAR_SYNC_CONCURRENCY = 10
 
 
 # UI Labels
@@ -63,6 +83,18 @@ BTN_CAL_ADD = "📆 Добавить в календарь"
 BTN_CAL_EDIT = "🗓 Изменить в календаре"
 BTN_CAL_AUTH = "🔗 Привязать календарь"
 BTN_CAL_UNLINK = "🔓 Отвязать календарь"
+BTN_CAL_SYNC = "🔄 Всё в календарь"
+
+MAIN_MENU = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(BTN_ADD), KeyboardButton(BTN_LIST)],
+        [KeyboardButton(BTN_EDIT)],
+        [KeyboardButton(BTN_CAL_ADD), KeyboardButton(BTN_CAL_EDIT)],
+        [KeyboardButton(BTN_CAL_SYNC)],
+        [KeyboardButton(BTN_CAL_AUTH), KeyboardButton(BTN_CAL_UNLINK)],
+    ],
+    resize_keyboard=True,
+)
 
 
 # Conversation states
@@ -85,92 +117,351 @@ class Task:
 
 
 
-def read_user_tasks() -> Dict[str, List[Dict]]:
-    if not DATA_FILE.exists():
-        return {}
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+# Pending calendar link, kept in user_data["oauth"] until the user sends the code
+@dataclass
+class OAuthState:
+    flow: InstalledAppFlow
+    user_id: int
+
+
+
+# One connection shared by worker threads; every statement runs under _DB_LOCK
+_DB: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.Lock()
+_TASK_COLUMNS = "id, text, priority, done, due_iso, calendar_event_id"
+
+
+
+def open_storage() -> None:
+    global _DB
+    # Read before storage.db exists, so a broken legacy file stops startup instead of
+    # leaving an empty database that would skip the import from then on
+    legacy = _read_legacy_json() if not DB_FILE.exists() else None
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    _DB = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+    _DB.execute("PRAGMA journal_mode=WAL")
+    _DB.execute("PRAGMA synchronous=NORMAL")
+    _DB.execute(
+        """CREATE TABLE IF NOT EXISTS tasks (
+            chat_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            priority TEXT NOT NULL DEFAULT 'normal',
+            done INTEGER NOT NULL DEFAULT 0,
+            due_iso TEXT,
+            calendar_event_id TEXT,
+            PRIMARY KEY (chat_id, id)
+        ) WITHOUT ROWID"""
+    )
+    if legacy is not None:
+        path, rows = legacy
+        with _DB_LOCK:
+            _DB.execute("BEGIN")
+            _DB.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            _DB.execute("COMMIT")
+        logging.info(f"Imported {len(rows)} tasks from {path}")
 
 
 
-def write_user_tasks(data: Dict[str, List[Dict]]) -> None:
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _read_legacy_json() -> Optional[Tuple[Path, List[Tuple]]]:
+    path = next((p for p in LEGACY_DATA_FILES if p.is_file()), None)
+    if path is None:
+        return None
+    data = path.read_bytes()
+    raw = orjson.loads(data) if orjson is not None else json.loads(data)
+    rows = [
+        (int(chat_id), t["id"], t.get("text", ""), t.get("priority", "normal"), int(bool(t.get("done"))),
+         t.get("due_iso"), t.get("calendar_event_id"))
+        for chat_id, tasks in raw.items()
+        for t in tasks
+        if "id" in t
+    ]
+    return path, rows
 
 
 
-def get_next_task_id(tasks: List[Dict]) -> int:
-    if not tasks:
-        return 1
-    return max(t.get("id", 0) for t in tasks) + 1
+def _row_to_task(row) -> Dict:
+    return {
+        "id": row[0],
+        "text": row[1],
+        "priority": row[2],
+        "done": bool(row[3]),
+        "due_iso": row[4],
+        "calendar_event_id": row[5],
+    }
+
+
+
+def _list_tasks_sync(chat_id: int) -> List[Dict]:
+    with _DB_LOCK:
+        rows = _DB.execute(
+            f"SELECT {_TASK_COLUMNS} FROM tasks WHERE chat_id = ? ORDER BY id", (chat_id,)
+        ).fetchall()
+    return [_row_to_task(r) for r in rows]
+
+
+
+def _add_task_sync(chat_id: int, text: str, priority: str, due_iso: Optional[str]) -> Dict:
+    # The lock keeps MAX(id) and the INSERT together, so concurrent adds never share an id
+    with _DB_LOCK:
+        (task_id,) = _DB.execute(
+            "SELECT COALESCE(MAX(id), 0) + 1 FROM tasks WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        _DB.execute(
+            "INSERT INTO tasks (chat_id, id, text, priority, due_iso) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, task_id, text, priority, due_iso),
+        )
+    return {"id": task_id, "text": text, "priority": priority, "done": False, "due_iso": due_iso, "calendar_event_id": None}
+
+
+
+def _update_task_sync(chat_id: int, task_id: int, fields: Dict) -> bool:
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _DB_LOCK:
+        cur = _DB.execute(
+            f"UPDATE tasks SET {assignments} WHERE chat_id = ? AND id = ?", (*fields.values(), chat_id, task_id)
+        )
+    return cur.rowcount > 0
+
+
+
+def _clear_calendar_links_sync(chat_id: int) -> int:
+    with _DB_LOCK:
+        cur = _DB.execute(
+            "UPDATE tasks SET calendar_event_id = NULL WHERE chat_id = ? AND calendar_event_id IS NOT NULL", (chat_id,)
+        )
+    return cur.rowcount
+
+
+
+# Held across awaits that read a task, call Google and write the result back, so two
+# updates from the same chat can't act on the same stale task; other chats run freely
+_CHAT_LOCKS: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+
+# Per-chat cache in front of storage.db: {chat_id: {task_id: task}}, loaded on first
+# access. Reads never leave the event loop; writes go to the database (on the thread
+# pool) and then into the cache, so both stay in step.
+_CACHE: Dict[int, Dict[int, Dict]] = {}
+# Bumped on every change to a chat's tasks; lets derived data (keyboards) spot staleness
+_TASKS_VERSION: Dict[int, int] = defaultdict(int)
+# Held from a database write until its cache update, so two writes to one chat reach
+# the cache in the order they were committed. Separate from _CHAT_LOCKS, which callers
+# may already hold while they write.
+_WRITE_LOCKS: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+
+async def _chat_tasks(chat_id: int) -> Dict[int, Dict]:
+    tasks = _CACHE.get(chat_id)
+    if tasks is None:
+        rows = await asyncio.to_thread(_list_tasks_sync, chat_id)
+        tasks = _CACHE.setdefault(chat_id, {t["id"]: t for t in rows})
+    return tasks
+
+
+
+async def list_chat_tasks(chat_id: int) -> List[Dict]:
+    return list((await _chat_tasks(chat_id)).values())
+
+
+
+async def get_task(chat_id: int, task_id: int) -> Optional[Dict]:
+    return (await _chat_tasks(chat_id)).get(task_id)
+
+
+
+async def add_task(chat_id: int, text: str, priority: str, due_iso: Optional[str]) -> Dict:
+    tasks = await _chat_tasks(chat_id)
+    async with _WRITE_LOCKS[chat_id]:
+        task = await asyncio.to_thread(_add_task_sync, chat_id, text, priority, due_iso)
+        tasks[task["id"]] = task
+        _TASKS_VERSION[chat_id] += 1
+    return task
+
+
+
+async def update_task(chat_id: int, task_id: int, **fields) -> bool:
+    task = (await _chat_tasks(chat_id)).get(task_id)
+    if task is None:
+        return False
+    async with _WRITE_LOCKS[chat_id]:
+        await asyncio.to_thread(_update_task_sync, chat_id, task_id, fields)
+        task.update(fields)
+        _TASKS_VERSION[chat_id] += 1
+    return True
+
+
+
+async def clear_calendar_links(chat_id: int) -> int:
+    tasks = await _chat_tasks(chat_id)
+    async with _WRITE_LOCKS[chat_id]:
+        removed = await asyncio.to_thread(_clear_calendar_links_sync, chat_id)
+        for task in tasks.values():
+            task["calendar_event_id"] = None
+        _TASKS_VERSION[chat_id] += 1
+    return removed
 
 
 
 # ---------------------------
 # Google Calendar helpers
 # ---------------------------
-def get_google_credentials() -> Optional[Credentials]:
-    creds: Optional[Credentials] = None
-    if GOOGLE_TOKEN_FILE.exists():
-        creds = Credentials.from_authorized_user_file(str(GOOGLE_TOKEN_FILE), GOOGLE_SCOPES)
+# Credentials loaded from token.json, shared by every handler; only re-read after
+# unlinking or a failed refresh, and replaced whenever a new token is saved
+_CREDS: Optional[Credentials] = None
+
+
+
+def save_google_token(creds: Credentials) -> None:
+    global _CREDS
+    with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
+        token.write(creds.to_json())
+    _CREDS = creds
+
+
+
+def forget_google_credentials() -> None:
+    global _CREDS
+    _CREDS = None
+
+
+
+async def get_google_credentials() -> Optional[Credentials]:
+    global _CREDS
+    if _CREDS is None and GOOGLE_TOKEN_FILE.exists():
+        _CREDS = Credentials.from_authorized_user_file(str(GOOGLE_TOKEN_FILE), GOOGLE_SCOPES)
+    creds = _CREDS
     if creds and creds.expired and creds.refresh_token:
         try:
-            creds.refresh(Request())
-            with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
-                token.write(creds.to_json())
+            await asyncio.to_thread(creds.refresh, Request())
+            save_google_token(creds)
         except Exception:
-            creds = None
+            _CREDS = creds = None
     return creds
 
 
 
+# Parsed credentials.json, read once on first use; it doesn't change while the bot runs
+_CLIENT_CONFIG: Optional[Dict] = None
+
+
+
+def load_client_config() -> Optional[Dict]:
+    global _CLIENT_CONFIG
+    if _CLIENT_CONFIG is None and GOOGLE_CREDENTIALS_FILE.exists():
+        with open(GOOGLE_CREDENTIALS_FILE, "r", encoding="utf-8") as f:
+            _CLIENT_CONFIG = json.load(f)
+    return _CLIENT_CONFIG
+
+
+
 def run_google_oauth_flow() -> Credentials:
-    flow = InstalledAppFlow.from_client_secrets_file(str(GOOGLE_CREDENTIALS_FILE), GOOGLE_SCOPES)
+    flow = InstalledAppFlow.from_client_config(load_client_config(), GOOGLE_SCOPES)
     creds = flow.run_local_server(port=0)
-    with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
-        token.write(creds.to_json())
+    save_google_token(creds)
     return creds
 
 
 
-def get_calendar_service(creds: Credentials):
-    return build("calendar", "v3", credentials=creds)
+# Shared async client for Calendar REST calls; opened in post_init, closed in post_shutdown
+_HTTP: Optional[httpx.AsyncClient] = None
+
+
+
+async def _auth_headers(creds: Credentials) -> Dict[str, str]:
+    if creds.expired and creds.refresh_token:
+        await asyncio.to_thread(creds.refresh, Request())
+        save_google_token(creds)
+    return {"Authorization": f"Bearer {creds.token}"}
+
+
+
+async def calendar_insert(creds: Credentials, body: Dict) -> Dict:
+    resp = await _HTTP.post(CALENDAR_EVENTS_URL, json=body, headers=await _auth_headers(creds))
+    resp.raise_for_status()
+    return resp.json()
+
+
+
+async def calendar_delete(creds: Credentials, event_id: str) -> None:
+    url = f"{CALENDAR_EVENTS_URL}/{quote(event_id, safe='')}"
+    resp = await _HTTP.delete(url, headers=await _auth_headers(creds))
+    resp.raise_for_status()
+
+
+
+def plus_one_hour(iso: str) -> str:
+    # due_iso is always YYYY-MM-DDTHH:MM:SS (parse_due_datetime), so bumping the hour
+    # field is enough unless it would roll over into the next day
+    hour = iso[11:13]
+    if len(iso) == 19 and hour.isdigit() and hour < "23":
+        return f"{iso[:11]}{int(hour) + 1:02d}{iso[13:]}"
+    return (datetime.fromisoformat(iso) + timedelta(hours=1)).isoformat()
+
+
+
+def build_task_event(task: Dict) -> Dict:
+    start = task["due_iso"]
+    return {
+        "summary": task["text"],
+        "description": f"Задача #{task['id']}",
+        "start": {"dateTime": start, "timeZone": CALENDAR_TIMEZONE},
+        "end": {"dateTime": plus_one_hour(start), "timeZone": CALENDAR_TIMEZONE},
+    }
+
+
+
+# YYYY-MM-DD [HH:MM]; same leniency as the strptime formats it replaces
+_DUE_RE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{1,2}))?")
 
 
 
 def parse_due_datetime(parts: List[str]) -> Optional[str]:
+    m = _DUE_RE.fullmatch(" ".join(parts[:2]))
+    if not m:
+        return None
+    year, month, day, hour, minute = m.groups()
     try:
-        if len(parts) == 1:
-            dt = datetime.strptime(parts[0], "%Y-%m-%d")
-            dt = dt.replace(hour=9, minute=0)
-        elif len(parts) >= 2:
-            dt = datetime.strptime(" ".join(parts[:2]), "%Y-%m-%d %H:%M")
-        else:
-            return None
-        return dt.isoformat()
+        dt = datetime(int(year), int(month), int(day), int(hour or 9), int(minute or 0))
     except ValueError:
         return None
+    return dt.isoformat()
 
 
 
 def build_tasks_keyboard(tasks: List[Dict], action_prefix: str) -> InlineKeyboardMarkup:
     buttons: List[List[InlineKeyboardButton]] = []
     for t in tasks[:25]:
-        label = f"{'✅' if t.get('done') else '⬜'} #{t.get('id')} • {t.get('text')[:32]}"
-        buttons.append([InlineKeyboardButton(label, callback_data=f"{action_prefix}|{t.get('id')}")])
+        task_id = t["id"]
+        label = f"{'✅' if t['done'] else '⬜'} #{task_id} • {t['text'][:32]}"
+        buttons.append([InlineKeyboardButton(label, callback_data=f"{action_prefix}|{task_id}")])
     return InlineKeyboardMarkup(buttons) if buttons else InlineKeyboardMarkup([[InlineKeyboardButton("Нет задач", callback_data="noop")]])
 
 
 
+# {(chat_id, action_prefix): (tasks version, keyboard)}
+_KEYBOARDS: Dict[Tuple[int, str], Tuple[int, InlineKeyboardMarkup]] = {}
+
+
+
+async def tasks_keyboard(chat_id: int, action_prefix: str) -> InlineKeyboardMarkup:
+    version = _TASKS_VERSION[chat_id]
+    cached = _KEYBOARDS.get((chat_id, action_prefix))
+    if cached and cached[0] == version:
+        return cached[1]
+    keyboard = build_tasks_keyboard(await list_chat_tasks(chat_id), action_prefix)
+    _KEYBOARDS[(chat_id, action_prefix)] = (version, keyboard)
+    return keyboard
+
+
+
+# Tasks always carry every column (see _row_to_task), so plain indexing is safe here
 def format_task_line(t: Dict) -> str:
-    status = "✅" if t.get("done") else "⬜"
-    pr = t.get("priority", "normal")
-    due = t.get("due_iso")
+    due = t["due_iso"]
     due_str = f" | до {due}" if due else ""
-    return f"{status} #{t.get('id')}. {t.get('text')} [p:{pr}]{due_str}"
+    return f"{'✅' if t['done'] else '⬜'} #{t['id']}. {t['text']} [p:{t['priority']}]{due_str}"
 
 
 
@@ -183,24 +474,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"Привет, {user_first}! Я твой помощник по задачам.\n\n"
         "Используй меню ниже для работы с задачами."
     )
-    keyboard = [
-        [KeyboardButton(BTN_ADD), KeyboardButton(BTN_LIST)],
-        [KeyboardButton(BTN_EDIT)],
-        [KeyboardButton(BTN_CAL_ADD), KeyboardButton(BTN_CAL_EDIT)],
-        [KeyboardButton(BTN_CAL_AUTH), KeyboardButton(BTN_CAL_UNLINK)],
-    ]
-    await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text(text, reply_markup=MAIN_MENU)
 
 
 
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    keyboard = [
-        [KeyboardButton(BTN_ADD), KeyboardButton(BTN_LIST)],
-        [KeyboardButton(BTN_EDIT)],
-        [KeyboardButton(BTN_CAL_ADD), KeyboardButton(BTN_CAL_EDIT)],
-        [KeyboardButton(BTN_CAL_AUTH), KeyboardButton(BTN_CAL_UNLINK)],
-    ]
-    await update.message.reply_text("Выберите действие:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text("Выберите действие:", reply_markup=MAIN_MENU)
 
 
 
@@ -261,41 +540,28 @@ async def add_wizard_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
     add_to_calendar = (query.data or "|").endswith("yes")
 
 
-    # Create task
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    new_id = get_next_task_id(tasks)
-    new_task = {
-        "id": new_id,
-        "text": context.user_data.get("new_task", {}).get("text", ""),
-        "priority": context.user_data.get("new_task", {}).get("priority", "normal"),
-        "done": False,
-        "due_iso": context.user_data.get("new_task", {}).get("due_iso"),
-        "calendar_event_id": None,
-    }
-    tasks.append(new_task)
-    data[chat_id] = tasks
-    write_user_tasks(data)
+    # Create task; credentials (and a possible token refresh) load while the row is written
+    chat_id = update.effective_chat.id
+    draft = context.user_data.get("new_task", {})
+    creds_job = asyncio.create_task(get_google_credentials()) if add_to_calendar else None
+    try:
+        new_task = await add_task(chat_id, draft.get("text", ""), draft.get("priority", "normal"), draft.get("due_iso"))
+    except BaseException:
+        # Don't leave the credentials load running unobserved when the task wasn't stored
+        if creds_job is not None:
+            creds_job.cancel()
+        raise
+    new_id = new_task["id"]
 
 
     # Optionally add to calendar
-    if add_to_calendar:
+    if creds_job is not None:
         try:
-            creds = get_google_credentials()
+            creds = await creds_job
             if creds:
-                service = get_calendar_service(creds)
-                start_dt = datetime.fromisoformat(new_task["due_iso"])
-                end_dt = start_dt + timedelta(hours=1)
-                event = {
-                    "summary": new_task["text"],
-                    "description": f"Задача #{new_id}",
-                    "start": {"dateTime": start_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
-                    "end": {"dateTime": end_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
-                }
-                created = service.events().insert(calendarId="primary", body=event).execute()
-                new_task["calendar_event_id"] = created.get("id")
-                write_user_tasks(data)
+                created = await calendar_insert(creds, build_task_event(new_task))
+                # update_task writes storage.db first and only then the cached task
+                await update_task(chat_id, new_id, calendar_event_id=created.get("id"))
         except Exception as e:
             logging.exception("Failed to add to calendar")
 
@@ -318,14 +584,11 @@ async def add_wizard_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
 # List and display
 # ---------------------------
 async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
+    tasks = await list_chat_tasks(update.effective_chat.id)
     if not tasks:
         await update.message.reply_text("Пока нет задач. Добавьте первую через меню!")
         return
-    lines = [format_task_line(t) for t in tasks]
-    await update.message.reply_text("\n".join(lines))
+    await update.message.reply_text("\n".join(map(format_task_line, tasks)))
 
 
 
@@ -337,14 +600,15 @@ async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 # ---------------------------
 async def calendar_auth(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Привязка Google Calendar через ссылку"""
-    if not GOOGLE_CREDENTIALS_FILE.exists():
+    client_config = load_client_config()
+    if not client_config:
         await update.message.reply_text("Не найден credentials.json. Разместите файл OAuth рядом с calendar_bot.py.")
         return
     
     try:
         # Создаем flow для получения URL
-        flow = InstalledAppFlow.from_client_secrets_file(
-            str(GOOGLE_CREDENTIALS_FILE), 
+        flow = InstalledAppFlow.from_client_config(
+            client_config,
             GOOGLE_SCOPES,
             redirect_uri='urn:ietf:wg:oauth:2.0:oob'
         )
@@ -364,10 +628,8 @@ async def calendar_auth(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             "Не добавляйте лишний текст!"
         )
         
-        # Сохраняем flow и флаг (flow хранится в памяти, не сериализуется)
-        context.user_data['oauth_flow'] = flow
-        context.user_data['awaiting_oauth_code'] = True
-        context.user_data['oauth_user_id'] = update.effective_user.id  # Для проверки пользователя
+        # Сохраняем flow и пользователя (flow хранится в памяти, не сериализуется)
+        context.user_data['oauth'] = OAuthState(flow, update.effective_user.id)
         
         logging.info(f"Awaiting OAuth code for user {update.effective_user.id}")
         
@@ -384,20 +646,12 @@ async def calendar_unlink(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     try:
         # Удаляем calendar_event_id из всех задач пользователя
-        data = read_user_tasks()
-        chat_id = str(update.effective_chat.id)
-        tasks = data.get(chat_id, [])
-        
-        events_removed = 0
-        for task in tasks:
-            if task.get("calendar_event_id"):
-                task["calendar_event_id"] = None
-                events_removed += 1
-        
-        if events_removed > 0:
-            write_user_tasks(data)
+        chat_id = update.effective_chat.id
+        async with _CHAT_LOCKS[chat_id]:
+            events_removed = await clear_calendar_links(chat_id)
         
         # Безопасное удаление/перезапись токена
+        forget_google_credentials()
         try:
             if GOOGLE_TOKEN_FILE.exists():
                 GOOGLE_TOKEN_FILE.unlink(missing_ok=True)
@@ -417,19 +671,66 @@ async def calendar_unlink(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 
+async def calendar_sync_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Добавление в календарь всех задач с дедлайном, ещё не связанных с событием"""
+    creds = await get_google_credentials()
+    if not creds:
+        await update.message.reply_text("Сначала привяжите Google Calendar.")
+        return
+    chat_id = update.effective_chat.id
+    async with _CHAT_LOCKS[chat_id]:
+        pending = [
+            t for t in await list_chat_tasks(chat_id)
+            if t["due_iso"] and not t["done"] and not t["calendar_event_id"]
+        ]
+        if not pending:
+            await update.message.reply_text("Нет задач для добавления в календарь.")
+            return
+
+
+        # Refresh once up front so the concurrent inserts don't all refresh the token
+        try:
+            await _auth_headers(creds)
+        except Exception:
+            logging.exception("Failed to refresh Google credentials")
+            await update.message.reply_text("Ошибка при добавлении в календарь.")
+            return
+        limit = asyncio.Semaphore(CALENDAR_SYNC_CONCURRENCY)
+
+        async def insert(t: Dict) -> Dict:
+            async with limit:
+                return await calendar_insert(creds, build_task_event(t))
+
+        results = await asyncio.gather(*(insert(t) for t in pending), return_exceptions=True)
+        added = 0
+        for t, result in zip(pending, results):
+            if isinstance(result, BaseException):
+                logging.error(f"Failed to add task #{t['id']} to calendar: {result}")
+                continue
+            try:
+                await update_task(chat_id, t["id"], calendar_event_id=result.get("id"))
+            except Exception:
+                logging.exception(f"Failed to store the calendar event of task #{t['id']}")
+                # Drop the unlinked event, or the next sync would add it again
+                try:
+                    await calendar_delete(creds, result["id"])
+                except Exception:
+                    logging.exception(f"Failed to delete orphaned event {result.get('id')}")
+                continue
+            added += 1
+        await update.message.reply_text(f"✅ Добавлено в Google Calendar: {added} из {len(pending)}")
+
+
+
 async def choose_task_for_calendar_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    await update.message.reply_text("Выберите задачу для добавления в календарь:", reply_markup=build_tasks_keyboard(tasks, "cal_add"))
+    keyboard = await tasks_keyboard(update.effective_chat.id, "cal_add")
+    await update.message.reply_text("Выберите задачу для добавления в календарь:", reply_markup=keyboard)
 
 
 
 async def choose_task_for_calendar_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-    await update.message.reply_text("Выберите задачу для изменения/удаления события в календаре:", reply_markup=build_tasks_keyboard(tasks, "cal_edit"))
+    keyboard = await tasks_keyboard(update.effective_chat.id, "cal_edit")
+    await update.message.reply_text("Выберите задачу для изменения/удаления события в календаре:", reply_markup=keyboard)
 
 
 
@@ -449,16 +750,14 @@ async def choose_edit_action(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def handle_edit_action(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     await query.answer()
     _, action = (query.data or "|").split("|", 1)
-    data = read_user_tasks()
-    chat_id = str(query.from_user.id)
-    tasks = data.get(chat_id, [])
+    chat_id = query.from_user.id
     
     if action == "prio":
-        await query.edit_message_text("Выберите задачу:", reply_markup=build_tasks_keyboard(tasks, "setprio_task"))
+        await query.edit_message_text("Выберите задачу:", reply_markup=await tasks_keyboard(chat_id, "setprio_task"))
     elif action == "due":
-        await query.edit_message_text("Выберите задачу:", reply_markup=build_tasks_keyboard(tasks, "setdue_task"))
+        await query.edit_message_text("Выберите задачу:", reply_markup=await tasks_keyboard(chat_id, "setdue_task"))
     elif action == "done":
-        await query.edit_message_text("Выберите задачу:", reply_markup=build_tasks_keyboard(tasks, "done_task"))
+        await query.edit_message_text("Выберите задачу:", reply_markup=await tasks_keyboard(chat_id, "done_task"))
 
 
 
@@ -473,26 +772,14 @@ async def on_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     arg = payload[1] if len(payload) > 1 else ""
 
 
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
-
-
-    def find_task(task_id: int):
-        for t in tasks:
-            if t.get("id") == task_id:
-                return t
-        return None
+    chat_id = update.effective_chat.id
 
 
     # Done task
     if action == "done_task":
         try:
             task_id = int(arg)
-            t = find_task(task_id)
-            if t:
-                t["done"] = True
-                write_user_tasks(data)
+            if await update_task(chat_id, task_id, done=True):
                 await query.edit_message_text(f"✅ Задача #{task_id} отмечена выполненной")
         except ValueError:
             pass
@@ -516,10 +803,7 @@ async def on_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         try:
             task_id = int(parts[0])
             pr = parts[1] if len(parts) > 1 else "normal"
-            t = find_task(task_id)
-            if t:
-                t["priority"] = pr
-                write_user_tasks(data)
+            if await update_task(chat_id, task_id, priority=pr):
                 await query.edit_message_text(f"Приоритет обновлён: #{task_id} -> {pr}")
         except Exception:
             pass
@@ -539,27 +823,23 @@ async def on_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # Calendar add
     if action == "cal_add":
-        try:
-            task_id = int(arg)
-            t = find_task(task_id)
-            if not t or not t.get("due_iso"):
-                await query.edit_message_text("У задачи нет дедлайна. Установите его сначала.")
-                return
-            creds = get_google_credentials()
-            if not creds:
-                await query.edit_message_text("Сначала привяжите Google Calendar.")
-                return
-            service = get_calendar_service(creds)
-            start_dt = datetime.fromisoformat(t["due_iso"])
-            end_dt = start_dt + timedelta(hours=1)
-            event = {"summary": t["text"], "description": f"Задача #{task_id}", "start": {"dateTime": start_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE}, "end": {"dateTime": end_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE}}
-            created = service.events().insert(calendarId="primary", body=event).execute()
-            t["calendar_event_id"] = created.get("id")
-            write_user_tasks(data)
-            await query.edit_message_text(f"✅ Событие создано в Google Calendar\n{created.get('htmlLink')}")
-        except Exception as e:
-            logging.exception("Failed calendar add")
-            await query.edit_message_text("Ошибка при добавлении в календарь.")
+        async with _CHAT_LOCKS[chat_id]:
+            try:
+                task_id = int(arg)
+                t = await get_task(chat_id, task_id)
+                if not t or not t.get("due_iso"):
+                    await query.edit_message_text("У задачи нет дедлайна. Установите его сначала.")
+                    return
+                creds = await get_google_credentials()
+                if not creds:
+                    await query.edit_message_text("Сначала привяжите Google Calendar.")
+                    return
+                created = await calendar_insert(creds, build_task_event(t))
+                await update_task(chat_id, task_id, calendar_event_id=created.get("id"))
+                await query.edit_message_text(f"✅ Событие создано в Google Calendar\n{created.get('htmlLink')}")
+            except Exception as e:
+                logging.exception("Failed calendar add")
+                await query.edit_message_text("Ошибка при добавлении в календарь.")
         return
 
 
@@ -573,24 +853,23 @@ async def on_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
     if action == "cal_delete":
-        try:
-            task_id = int(arg)
-            t = find_task(task_id)
-            if not t or not t.get("calendar_event_id"):
-                await query.edit_message_text("У задачи нет связанного события календаря.")
-                return
-            creds = get_google_credentials()
-            if not creds:
-                await query.edit_message_text("Сначала привяжите Google Calendar.")
-                return
-            service = get_calendar_service(creds)
-            service.events().delete(calendarId="primary", eventId=t["calendar_event_id"]).execute()
-            t["calendar_event_id"] = None
-            write_user_tasks(data)
-            await query.edit_message_text(f"✅ Событие календаря удалено для задачи #{task_id}")
-        except Exception as e:
-            logging.exception("Failed calendar delete")
-            await query.edit_message_text("Ошибка при удалении события.")
+        async with _CHAT_LOCKS[chat_id]:
+            try:
+                task_id = int(arg)
+                t = await get_task(chat_id, task_id)
+                if not t or not t.get("calendar_event_id"):
+                    await query.edit_message_text("У задачи нет связанного события календаря.")
+                    return
+                creds = await get_google_credentials()
+                if not creds:
+                    await query.edit_message_text("Сначала привяжите Google Calendar.")
+                    return
+                await calendar_delete(creds, t["calendar_event_id"])
+                await update_task(chat_id, task_id, calendar_event_id=None)
+                await query.edit_message_text(f"✅ Событие календаря удалено для задачи #{task_id}")
+            except Exception as e:
+                logging.exception("Failed calendar delete")
+                await query.edit_message_text("Ошибка при удалении события.")
         return
 
 
@@ -604,6 +883,19 @@ async def on_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ---------------------------
 # Text message handlers
 # ---------------------------
+BUTTON_DISPATCH = {
+    BTN_ADD: add_wizard_start,
+    BTN_LIST: list_tasks,
+    BTN_EDIT: choose_edit_action,
+    BTN_CAL_ADD: choose_task_for_calendar_add,
+    BTN_CAL_EDIT: choose_task_for_calendar_edit,
+    BTN_CAL_AUTH: calendar_auth,
+    BTN_CAL_UNLINK: calendar_unlink,
+    BTN_CAL_SYNC: calendar_sync_all,
+}
+
+
+
 # В функции handle_text_messages - обновите начало:
 async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = (update.message.text or "").strip()
@@ -612,20 +904,19 @@ async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYP
     logging.info(f"Processing text message from user {user_id}: '{text[:50]}...'")  # Логируем для отладки
 
     # Handle OAuth code (ПЕРВЫЙ приоритет!)
-    if context.user_data.get('awaiting_oauth_code') and context.user_data.get('oauth_user_id') == user_id:
+    oauth = context.user_data.get('oauth')
+    if oauth and oauth.user_id == user_id:
         logging.info(f"Processing OAuth code for user {user_id}: {text[:20]}...")
         
         try:
-            flow = context.user_data.get('oauth_flow')
-            if not flow:
-                raise ValueError("OAuth flow not found")
+            flow = oauth.flow
             
             # Проверяем, что код начинается с '4/' (стандарт для OOB)
             if not text.startswith('4/'):
                 raise ValueError("Invalid OAuth code format. Must start with '4/'")
             
             # Получаем токен по коду
-            flow.fetch_token(code=text)
+            await asyncio.to_thread(flow.fetch_token, code=text)
             creds = flow.credentials
             
             # Проверяем, что токен получен
@@ -633,8 +924,7 @@ async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYP
                 raise ValueError("No token received")
             
             # Сохраняем токен в файл
-            with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
-                token.write(creds.to_json())
+            save_google_token(creds)
             
             logging.info(f"OAuth successful for user {user_id}")
             
@@ -644,9 +934,7 @@ async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             
             # Очищаем context
-            context.user_data.pop('oauth_flow', None)
-            context.user_data.pop('awaiting_oauth_code', None)
-            context.user_data.pop('oauth_user_id', None)
+            context.user_data.pop('oauth', None)
             
             return
             
@@ -661,7 +949,7 @@ async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             
             # Не очищаем флаг, чтобы пользователь мог попробовать снова
-            # context.user_data.pop('awaiting_oauth_code', None)  # Раскомментировать, если нужно сбросить
+            # context.user_data.pop('oauth', None)  # Раскомментировать, если нужно сбросить
             return
 
     # Handle due date entry
@@ -669,41 +957,18 @@ async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYP
         task_id = context.user_data.pop("set_due_task_id")
         due_iso = parse_due_datetime(text.split())
         if due_iso:
-            data = read_user_tasks()
-            chat_id = str(update.effective_chat.id)
-            tasks = data.get(chat_id, [])
-            for t in tasks:
-                if t.get("id") == task_id:
-                    t["due_iso"] = due_iso
-                    write_user_tasks(data)
-                    await update.message.reply_text(f"Дедлайн установлен для задачи #{task_id}: {due_iso}")
-                    return
-            await update.message.reply_text("Задача не найдена")
+            if await update_task(update.effective_chat.id, task_id, due_iso=due_iso):
+                await update.message.reply_text(f"Дедлайн установлен для задачи #{task_id}: {due_iso}")
+            else:
+                await update.message.reply_text("Задача не найдена")
         else:
             await update.message.reply_text("Неверный формат. Введите YYYY-MM-DD [HH:MM]")
         return
 
-    # Handle menu buttons (остальной код без изменений)
-    if text == BTN_ADD:
-        await add_wizard_start(update, context)
-        return
-    if text == BTN_LIST:
-        await list_tasks(update, context)
-        return
-    if text == BTN_EDIT:
-        await choose_edit_action(update, context)
-        return
-    if text == BTN_CAL_ADD:
-        await choose_task_for_calendar_add(update, context)
-        return
-    if text == BTN_CAL_EDIT:
-        await choose_task_for_calendar_edit(update, context)
-        return
-    if text == BTN_CAL_AUTH:
-        await calendar_auth(update, context)
-        return
-    if text == BTN_CAL_UNLINK:
-        await calendar_unlink(update, context)
+    # Handle menu buttons
+    handler = BUTTON_DISPATCH.get(text)
+    if handler:
+        await handler(update, context)
         return
 
 
@@ -721,13 +986,34 @@ def build_app() -> Application:
 
 
     async def post_init(application: Application) -> None:
+        global _HTTP
         await application.bot.set_my_commands([
             BotCommand("start", "Показать меню"),
             BotCommand("menu", "Показать меню"),
         ])
-
-
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
+        # HTTP/2 multiplexes Calendar requests over one connection
+        _HTTP = httpx.AsyncClient(http2=True, timeout=20.0)
+
+
+    async def post_shutdown(application: Application) -> None:
+        if _HTTP is not None:
+            await _HTTP.aclose()
+        if _DB is not None:
+            # A worker thread may still be inside a statement
+            with _DB_LOCK:
+                _DB.close()
+
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        # Queues sends under Telegram's flood limits and retries 429s instead of failing
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
 
     # Commands
@@ -751,23 +1037,40 @@ def build_app() -> Application:
     ))
 
 
-    # Inline callbacks
-    app.add_handler(CallbackQueryHandler(on_inline_callback, pattern=r"^.+"))
+    # Inline callbacks; calendar calls can take a while, so don't hold up other chats
+    app.add_handler(CallbackQueryHandler(on_inline_callback, pattern=r"^.+", block=False))
 
 
     # Text messages
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages, block=False))
 
 
     return app
 
 
 
+def setup_logging() -> logging.handlers.QueueListener:
+    # Handlers only enqueue records; formatting and the stderr write happen on the listener thread
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+
 def main() -> None:
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-    DATA_FILE.touch(exist_ok=True)
-    app = build_app()
-    app.run_polling()
+    listener = setup_logging()
+    try:
+        open_storage()
+        app = build_app()
+        app.run_polling()
+    finally:
+        listener.stop()
 
 
 
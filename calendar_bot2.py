@@ -2,10 +2,19 @@ import asyncio
 import json
 import logging
 import os
+import re
+from collections import defaultdict
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Optional
+from urllib.parse import quote
+
+import httpx
+try:
+    import orjson
+except ImportError:  # optional speedup, the stdlib json module is used otherwise
+    orjson = None
 
 from dotenv import load_dotenv
 from telegram import (
@@ -27,9 +36,9 @@ from telegram.ext import (
     ConversationHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
 # Google Calendar imports
-from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -46,8 +55,21 @@ DATA_FILE = Path(__file__).with_name("storage.json")
 GOOGLE_TOKEN_FILE = Path(__file__).with_name("token.json")
 GOOGLE_CREDENTIALS_FILE = Path(__file__).with_name("credentials.json")
 
+# How often pending task changes are written back to storage.json, in seconds
+STORAGE_FLUSH_INTERVAL = 2.0
+# Long-poll timeout for getUpdates, in seconds
+POLL_TIMEOUT = 50
+# Connections for Bot API calls made by handlers (answers, edits, replies)
+TELEGRAM_POOL_SIZE = 64
+
+# Telegram rejects messages over 4096 characters; task lists are split below that
+MESSAGE_CHUNK_LIMIT = 4000
+# fsync each flush before swapping files in; off by default, the rename alone keeps the file whole
+STORAGE_FSYNC = os.getenv("STORAGE_FSYNC", "") == "1"
+
 # If modifying these scopes, delete the file token.json.
 GOOGLE_SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+CALENDAR_EVENTS_URL = "https://www.googleapis.com/calendar/v3/calendars/primary/events"
 
 # UI Labels
 BTN_ADD = "➕ Добавить задачу"
@@ -60,12 +82,38 @@ BTN_CAL_AUTH = "🔗 Привязать календарь"
 # Conversation states
 ADD_TITLE, ADD_DATETIME, ADD_PRIORITY, ADD_CALENDAR = range(4)
 EDIT_CHOOSE_ACTION, EDIT_CHOOSE_TASK_PRIO, EDIT_CHOOSE_TASK_DUE = range(4, 7)
+SET_DUE_INPUT = 7
+
+# Static keyboards, built once and reused by every handler
+MAIN_MENU_MARKUP = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(BTN_ADD), KeyboardButton(BTN_LIST)],
+        [KeyboardButton(BTN_EDIT)],
+        [KeyboardButton(BTN_CAL_ADD), KeyboardButton(BTN_CAL_EDIT)],
+        [KeyboardButton(BTN_CAL_AUTH)],
+    ],
+    resize_keyboard=True,
+)
+PRIORITY_KB = InlineKeyboardMarkup([[
+    InlineKeyboardButton("low", callback_data="prio|low"),
+    InlineKeyboardButton("normal", callback_data="prio|normal"),
+    InlineKeyboardButton("high", callback_data="prio|high"),
+]])
+ADDCAL_KB = InlineKeyboardMarkup([[
+    InlineKeyboardButton("Добавить в календарь", callback_data="addcal|yes"),
+    InlineKeyboardButton("Не добавлять", callback_data="addcal|no")
+]])
+EDIT_ACTION_KB = InlineKeyboardMarkup([[
+    InlineKeyboardButton("Изменить приоритет", callback_data="editact|prio"),
+    InlineKeyboardButton("Установить дедлайн", callback_data="editact|due"),
+    InlineKeyboardButton("Отметить выполненной", callback_data="editact|done"),
+]])
 
 
 # ---------------------------
 # Data model and persistence
 # ---------------------------
-@dataclass
+@dataclass(slots=True)
 class Task:
     id: int
     text: str
@@ -75,84 +123,222 @@ class Task:
     calendar_event_id: Optional[str] = None
 
 
-def read_user_tasks() -> Dict[str, List[Dict]]:
-    if not DATA_FILE.exists():
-        return {}
+# storage.json is read once at startup into {chat_id: {task_id: task}} (in id order);
+# handlers work on this dict and only mark it dirty, and flush_user_tasks writes it
+# back from a repeating job in the original list-per-chat layout
+_STORE: Dict[str, Dict[int, Task]] = {}
+_DIRTY = asyncio.Event()
+
+
+# Held across the awaits between reading a task and storing a calendar result for it,
+# so two updates from one chat can't interleave there; other chats aren't blocked
+_CHAT_LOCKS: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _task_from_dict(t: Dict) -> Task:
+    # Missing fields get defaults, so one incomplete record can't stop the bot from starting
+    return Task(
+        id=int(t["id"]),
+        text=t.get("text", ""),
+        priority=t.get("priority", "normal"),
+        done=bool(t.get("done")),
+        due_iso=t.get("due_iso"),
+        calendar_event_id=t.get("calendar_event_id"),
+    )
+
+
+def load_user_tasks() -> None:
+    # Older versions created an empty storage.json on startup
+    if not DATA_FILE.exists() or DATA_FILE.stat().st_size == 0:
+        return
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        data = DATA_FILE.read_bytes()
+        raw = orjson.loads(data) if orjson is not None else json.loads(data)
     except Exception:
-        return {}
+        logging.exception(f"Failed to read {DATA_FILE}, starting with no tasks")
+        return
+    for chat_id, tasks in raw.items():
+        _STORE[chat_id] = {
+            int(t["id"]): _task_from_dict(t)
+            for t in sorted(tasks, key=lambda t: int(t.get("id", 0)))
+            if "id" in t
+        }
 
 
-def write_user_tasks(data: Dict[str, List[Dict]]) -> None:
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def chat_tasks(chat_id: str) -> Dict[int, Task]:
+    return _STORE.get(chat_id, {})
 
 
-def get_next_task_id(tasks: List[Dict]) -> int:
-    if not tasks:
-        return 1
-    return max(t.get("id", 0) for t in tasks) + 1
+def write_user_tasks() -> None:
+    _DIRTY.set()
+
+
+def _dump_storage(data: Dict[str, List[Dict]]) -> bytes:
+    # Compact output: the file is only read back by the bot
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _write_storage_file(payload: bytes) -> None:
+    # Write next to the target and swap it in, so a crash never leaves a torn file
+    tmp = DATA_FILE.with_suffix(".json.tmp")
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        if STORAGE_FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, DATA_FILE)
+
+
+async def flush_user_tasks(context: Optional[ContextTypes.DEFAULT_TYPE] = None) -> None:
+    if not _DIRTY.is_set():
+        return
+    _DIRTY.clear()
+    # Serialize on the loop so the snapshot can't change underneath; only the disk write is offloaded
+    payload = _dump_storage({chat_id: [asdict(t) for t in tasks.values()] for chat_id, tasks in _STORE.items()})
+    try:
+        await asyncio.to_thread(_write_storage_file, payload)
+    except Exception:
+        _DIRTY.set()
+        logging.exception("Failed to write storage")
+
+
+def get_next_task_id(tasks: Dict[int, Task]) -> int:
+    # Ids only grow and tasks are kept in id order, so the last key is the largest
+    return next(reversed(tasks), 0) + 1
 
 
 # ---------------------------
 # Google Calendar helpers
 # ---------------------------
-def get_google_credentials() -> Optional[Credentials]:
-    creds: Optional[Credentials] = None
-    if GOOGLE_TOKEN_FILE.exists():
-        creds = Credentials.from_authorized_user_file(str(GOOGLE_TOKEN_FILE), GOOGLE_SCOPES)
+# Credentials parsed from token.json once and shared by all callbacks; refreshes update
+# the object in place and every saved token replaces it
+_CREDS: Optional[Credentials] = None
+
+
+def save_google_token(creds: Credentials) -> None:
+    global _CREDS
+    with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
+        token.write(creds.to_json())
+    _CREDS = creds
+
+
+async def get_google_credentials() -> Optional[Credentials]:
+    global _CREDS
+    if _CREDS is None and GOOGLE_TOKEN_FILE.exists():
+        _CREDS = Credentials.from_authorized_user_file(str(GOOGLE_TOKEN_FILE), GOOGLE_SCOPES)
+    creds = _CREDS
     if creds and creds.expired and creds.refresh_token:
         try:
-            creds.refresh(Request())
-            with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
-                token.write(creds.to_json())
+            await asyncio.to_thread(creds.refresh, Request())
+            save_google_token(creds)
         except Exception:
-            creds = None
+            _CREDS = creds = None
     return creds
 
 
 def run_google_oauth_flow() -> Credentials:
     flow = InstalledAppFlow.from_client_secrets_file(str(GOOGLE_CREDENTIALS_FILE), GOOGLE_SCOPES)
     creds = flow.run_local_server(port=0)
-    with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
-        token.write(creds.to_json())
+    save_google_token(creds)
     return creds
 
 
-def get_calendar_service(creds: Credentials):
-    return build("calendar", "v3", credentials=creds)
+# Shared async client for Calendar REST calls; opened in post_init, closed in post_shutdown
+_HTTP: Optional[httpx.AsyncClient] = None
+
+
+async def _auth_headers(creds: Credentials) -> Dict[str, str]:
+    if creds.expired and creds.refresh_token:
+        await asyncio.to_thread(creds.refresh, Request())
+        save_google_token(creds)
+    return {"Authorization": f"Bearer {creds.token}"}
+
+
+async def calendar_insert(creds: Credentials, body: Dict) -> Dict:
+    resp = await _HTTP.post(CALENDAR_EVENTS_URL, json=body, headers=await _auth_headers(creds))
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def calendar_delete(creds: Credentials, event_id: str) -> None:
+    url = f"{CALENDAR_EVENTS_URL}/{quote(event_id, safe='')}"
+    resp = await _HTTP.delete(url, headers=await _auth_headers(creds))
+    resp.raise_for_status()
+
+
+def build_task_event(task: Task) -> Dict:
+    start_dt = datetime.fromisoformat(task.due_iso)
+    end_dt = start_dt + timedelta(hours=1)
+    return {
+        "summary": task.text,
+        "description": f"Задача #{task.id}",
+        "start": {"dateTime": start_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
+        "end": {"dateTime": end_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
+    }
+
+
+async def add_task_event(chat_id: str, task: Task) -> None:
+    async with _CHAT_LOCKS[chat_id]:
+        try:
+            creds = await get_google_credentials()
+            if not creds:
+                return
+            created = await calendar_insert(creds, build_task_event(task))
+            task.calendar_event_id = created.get("id")
+            write_user_tasks()
+        except Exception:
+            logging.exception("Failed to add to calendar")
+
+
+# YYYY-MM-DD [HH:MM]; same leniency as the strptime formats it replaces
+_DUE_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{1,2}))?$")
 
 
 def parse_due_datetime(parts: List[str]) -> Optional[str]:
+    m = _DUE_RE.match(" ".join(parts[:2]))
+    if not m:
+        return None
+    year, month, day, hour, minute = m.groups()
     try:
-        if len(parts) == 1:
-            dt = datetime.strptime(parts[0], "%Y-%m-%d")
-            dt = dt.replace(hour=9, minute=0)
-        elif len(parts) >= 2:
-            dt = datetime.strptime(" ".join(parts[:2]), "%Y-%m-%d %H:%M")
-        else:
-            return None
-        return dt.isoformat()
+        # Default time at 09:00
+        dt = datetime(int(year), int(month), int(day), int(hour or 9), int(minute or 0))
     except ValueError:
         return None
+    return dt.isoformat()
 
 
-def build_tasks_keyboard(tasks: List[Dict], action_prefix: str) -> InlineKeyboardMarkup:
+def build_tasks_keyboard(tasks: List[Task], action_prefix: str) -> InlineKeyboardMarkup:
     buttons: List[List[InlineKeyboardButton]] = []
     for t in tasks[:25]:
-        label = f"{'✅' if t.get('done') else '⬜'} #{t.get('id')} • {t.get('text')[:32]}"
-        buttons.append([InlineKeyboardButton(label, callback_data=f"{action_prefix}|{t.get('id')}")])
+        label = f"{'✅' if t.done else '⬜'} #{t.id} • {t.text[:32]}"
+        buttons.append([InlineKeyboardButton(label, callback_data=f"{action_prefix}|{t.id}")])
     return InlineKeyboardMarkup(buttons) if buttons else InlineKeyboardMarkup([[InlineKeyboardButton("Нет задач", callback_data="noop")]])
 
 
-def format_task_line(t: Dict) -> str:
-    status = "✅" if t.get("done") else "⬜"
-    pr = t.get("priority", "normal")
-    due = t.get("due_iso")
+def format_task_line(t: Task) -> str:
+    due = t.due_iso
     due_str = f" | до {due}" if due else ""
-    return f"{status} #{t.get('id')}. {t.get('text')} [p:{pr}]{due_str}"
+    return f"{'✅' if t.done else '⬜'} #{t.id}. {t.text} [p:{t.priority}]{due_str}"
+
+
+def chunk_lines(lines: List[str], limit: int = MESSAGE_CHUNK_LIMIT) -> List[str]:
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for line in lines:
+        # A single overlong task would still exceed the limit on its own, so cut it short
+        if len(line) > limit:
+            line = line[:limit - 1] + "…"
+        if current and size + len(line) + 1 > limit:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
 
 
 # ---------------------------
@@ -164,23 +350,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"Привет, {user_first}! Я твой помощник по задачам.\n\n"
         "Используй меню ниже для работы с задачами."
     )
-    keyboard = [
-        [KeyboardButton(BTN_ADD), KeyboardButton(BTN_LIST)],
-        [KeyboardButton(BTN_EDIT)],
-        [KeyboardButton(BTN_CAL_ADD), KeyboardButton(BTN_CAL_EDIT)],
-        [KeyboardButton(BTN_CAL_AUTH)],
-    ]
-    await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text(text, reply_markup=MAIN_MENU_MARKUP)
 
 
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    keyboard = [
-        [KeyboardButton(BTN_ADD), KeyboardButton(BTN_LIST)],
-        [KeyboardButton(BTN_EDIT)],
-        [KeyboardButton(BTN_CAL_ADD), KeyboardButton(BTN_CAL_EDIT)],
-        [KeyboardButton(BTN_CAL_AUTH)],
-    ]
-    await update.message.reply_text("Выберите действие:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text("Выберите действие:", reply_markup=MAIN_MENU_MARKUP)
 
 
 # ---------------------------
@@ -208,12 +382,7 @@ async def add_wizard_datetime(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Неверный формат. Введите YYYY-MM-DD [HH:MM]:")
         return ADD_DATETIME
     context.user_data["new_task"]["due_iso"] = due_iso
-    keyboard = InlineKeyboardMarkup([[
-        InlineKeyboardButton("low", callback_data="prio|low"),
-        InlineKeyboardButton("normal", callback_data="prio|normal"),
-        InlineKeyboardButton("high", callback_data="prio|high"),
-    ]])
-    await update.message.reply_text("Выберите приоритет (по умолчанию normal):", reply_markup=keyboard)
+    await update.message.reply_text("Выберите приоритет (по умолчанию normal):", reply_markup=PRIORITY_KB)
     return ADD_PRIORITY
 
 
@@ -222,11 +391,7 @@ async def add_wizard_priority(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     _, pr = (query.data or "|").split("|", 1)
     context.user_data["new_task"]["priority"] = pr or "normal"
-    keyboard = InlineKeyboardMarkup([[
-        InlineKeyboardButton("Добавить в календарь", callback_data="addcal|yes"),
-        InlineKeyboardButton("Не добавлять", callback_data="addcal|no")
-    ]])
-    await query.edit_message_text("Добавить эту задачу в Google Calendar?", reply_markup=keyboard)
+    await query.edit_message_text("Добавить эту задачу в Google Calendar?", reply_markup=ADDCAL_KB)
     return ADD_CALENDAR
 
 
@@ -236,46 +401,27 @@ async def add_wizard_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
     add_to_calendar = (query.data or "|").endswith("yes")
 
     # Create task
-    data = read_user_tasks()
     chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
+    tasks = _STORE.setdefault(chat_id, {})
     new_id = get_next_task_id(tasks)
-    new_task = {
-        "id": new_id,
-        "text": context.user_data.get("new_task", {}).get("text", ""),
-        "priority": context.user_data.get("new_task", {}).get("priority", "normal"),
-        "done": False,
-        "due_iso": context.user_data.get("new_task", {}).get("due_iso"),
-        "calendar_event_id": None,
-    }
-    tasks.append(new_task)
-    data[chat_id] = tasks
-    write_user_tasks(data)
+    draft = context.user_data.get("new_task", {})
+    new_task = Task(
+        id=new_id,
+        text=draft.get("text", ""),
+        priority=draft.get("priority", "normal"),
+        due_iso=draft.get("due_iso"),
+    )
+    tasks[new_id] = new_task
+    write_user_tasks()
 
-    # Optionally add to calendar
+    # Optionally add to calendar; runs in the background so the reply doesn't wait on Google
     if add_to_calendar:
-        try:
-            creds = get_google_credentials()
-            if creds:
-                service = get_calendar_service(creds)
-                start_dt = datetime.fromisoformat(new_task["due_iso"])
-                end_dt = start_dt + timedelta(hours=1)
-                event = {
-                    "summary": new_task["text"],
-                    "description": f"Задача #{new_id}",
-                    "start": {"dateTime": start_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
-                    "end": {"dateTime": end_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE},
-                }
-                created = service.events().insert(calendarId="primary", body=event).execute()
-                new_task["calendar_event_id"] = created.get("id")
-                write_user_tasks(data)
-        except Exception as e:
-            logging.exception("Failed to add to calendar")
+        context.application.create_task(add_task_event(chat_id, new_task), update=update)
 
     # Show confirmation
-    reply = f"✅ Задача #{new_id} создана: {new_task['text']} [p:{new_task['priority']}]"
-    if new_task.get("due_iso"):
-        reply += f" | до {new_task['due_iso']}"
+    reply = f"✅ Задача #{new_id} создана: {new_task.text} [p:{new_task.priority}]"
+    if new_task.due_iso:
+        reply += f" | до {new_task.due_iso}"
     await query.edit_message_text(reply)
 
     # Show list of tasks
@@ -288,14 +434,15 @@ async def add_wizard_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
 # List and display
 # ---------------------------
 async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
+    tasks = chat_tasks(str(update.effective_chat.id))
+    # effective_message: also called from the add wizard, where the update is a callback query
+    message = update.effective_message
     if not tasks:
-        await update.message.reply_text("Пока нет задач. Добавьте первую через меню!")
+        await message.reply_text("Пока нет задач. Добавьте первую через меню!")
         return
-    lines = [format_task_line(t) for t in tasks]
-    await update.message.reply_text("\n".join(lines))
+    # Sent one after another so the pages arrive in order
+    for chunk in chunk_lines([format_task_line(t) for t in tasks.values()]):
+        await message.reply_text(chunk)
 
 
 # ---------------------------
@@ -330,54 +477,15 @@ async def calendar_auth(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception as e:
         logging.exception("Failed to start OAuth flow")
         await update.message.reply_text("Ошибка при создании ссылки авторизации.")
-        
-async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = (update.message.text or "").strip()
-
-    # Handle OAuth code
-    if context.user_data.get('awaiting_oauth_code'):
-        try:
-            flow = context.user_data.get('oauth_flow')
-            if flow:
-                # Получаем токен по коду
-                flow.fetch_token(code=text)
-                creds = flow.credentials
-                
-                # Сохраняем токен
-                with open(GOOGLE_TOKEN_FILE, "w", encoding="utf-8") as token:
-                    token.write(creds.to_json())
-                
-                await update.message.reply_text("✅ Google Calendar успешно привязан!")
-                
-                # Очищаем context
-                context.user_data.pop('oauth_flow', None)
-                context.user_data.pop('awaiting_oauth_code', None)
-                return
-        except Exception as e:
-            logging.exception("Failed to process OAuth code")
-            await update.message.reply_text(
-                "❌ Ошибка при обработке кода. Попробуйте еще раз или используйте команду /menu"
-            )
-            context.user_data.pop('oauth_flow', None)
-            context.user_data.pop('awaiting_oauth_code', None)
-            return
-
-    # Handle due date entry
-    if "set_due_task_id" in context.user_data:
-        # ... остальной код
 
 
 async def choose_task_for_calendar_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
+    tasks = list(chat_tasks(str(update.effective_chat.id)).values())
     await update.message.reply_text("Выберите задачу для добавления в календарь:", reply_markup=build_tasks_keyboard(tasks, "cal_add"))
 
 
 async def choose_task_for_calendar_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
+    tasks = list(chat_tasks(str(update.effective_chat.id)).values())
     await update.message.reply_text("Выберите задачу для изменения/удаления события в календаре:", reply_markup=build_tasks_keyboard(tasks, "cal_edit"))
 
 
@@ -385,20 +493,13 @@ async def choose_task_for_calendar_edit(update: Update, context: ContextTypes.DE
 # Edit task operations
 # ---------------------------
 async def choose_edit_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    keyboard = InlineKeyboardMarkup([[
-        InlineKeyboardButton("Изменить приоритет", callback_data="editact|prio"),
-        InlineKeyboardButton("Установить дедлайн", callback_data="editact|due"),
-        InlineKeyboardButton("Отметить выполненной", callback_data="editact|done"),
-    ]])
-    await update.message.reply_text("Что изменить?", reply_markup=keyboard)
+    await update.message.reply_text("Что изменить?", reply_markup=EDIT_ACTION_KB)
 
 
 async def handle_edit_action(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     await query.answer()
     _, action = (query.data or "|").split("|", 1)
-    data = read_user_tasks()
-    chat_id = str(query.from_user.id)
-    tasks = data.get(chat_id, [])
+    tasks = list(chat_tasks(str(query.from_user.id)).values())
     
     if action == "prio":
         await query.edit_message_text("Выберите задачу:", reply_markup=build_tasks_keyboard(tasks, "setprio_task"))
@@ -408,177 +509,205 @@ async def handle_edit_action(query, context: ContextTypes.DEFAULT_TYPE) -> None:
         await query.edit_message_text("Выберите задачу:", reply_markup=build_tasks_keyboard(tasks, "done_task"))
 
 
-# ---------------------------
-# Inline callback handlers
-# ---------------------------
-async def on_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# Set due: the setdue_task| button starts a one-step conversation, so only the next text
+# message from that user is read as the date
+async def set_due_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    payload = (query.data or "|").split("|", 1)
-    action = payload[0]
-    arg = payload[1] if len(payload) > 1 else ""
+    try:
+        task_id = int((query.data or "").split("|", 1)[1])
+    except (IndexError, ValueError):
+        return ConversationHandler.END
+    context.user_data["set_due_task_id"] = task_id
+    await query.edit_message_text("Отправьте дату в формате YYYY-MM-DD [HH:MM]")
+    return SET_DUE_INPUT
 
-    data = read_user_tasks()
-    chat_id = str(update.effective_chat.id)
-    tasks = data.get(chat_id, [])
 
-    def find_task(task_id: int):
-        for t in tasks:
-            if t.get("id") == task_id:
-                return t
-        return None
+async def set_due_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    task_id = context.user_data.pop("set_due_task_id", None)
+    due_iso = parse_due_datetime((update.message.text or "").strip().split())
+    if not due_iso:
+        await update.message.reply_text("Неверный формат. Введите YYYY-MM-DD [HH:MM]")
+        return ConversationHandler.END
+    t = chat_tasks(str(update.effective_chat.id)).get(task_id)
+    if not t:
+        await update.message.reply_text("Задача не найдена")
+        return ConversationHandler.END
+    t.due_iso = due_iso
+    write_user_tasks()
+    await update.message.reply_text(f"Дедлайн установлен для задачи #{task_id}: {due_iso}")
+    return ConversationHandler.END
 
-    # Done task
-    if action == "done_task":
-        try:
-            task_id = int(arg)
-            t = find_task(task_id)
-            if t:
-                t["done"] = True
-                write_user_tasks(data)
-                await query.edit_message_text(f"✅ Задача #{task_id} отмечена выполненной")
-        except ValueError:
-            pass
-        return
 
-    # Change priority - choose task
-    if action == "setprio_task":
-        keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("low", callback_data=f"setprio|{arg}|low"),
-            InlineKeyboardButton("normal", callback_data=f"setprio|{arg}|normal"),
-            InlineKeyboardButton("high", callback_data=f"setprio|{arg}|high"),
-        ]])
-        await query.edit_message_text("Выберите приоритет:", reply_markup=keyboard)
-        return
+# ---------------------------
+# Inline callback handlers
+# ---------------------------
+# Each handler gets the callback query, the part of callback_data after the action,
+# and the chat's tasks; on_inline_callback picks one by action name.
+async def _h_done_task(query, context: ContextTypes.DEFAULT_TYPE, arg: str, chat_id: str, tasks: Dict[int, Task]) -> None:
+    try:
+        task_id = int(arg)
+        t = tasks.get(task_id)
+        if t:
+            t.done = True
+            write_user_tasks()
+            await query.edit_message_text(f"✅ Задача #{task_id} отмечена выполненной")
+    except ValueError:
+        pass
 
-    # Change priority - execute
-    if action == "setprio":
-        parts = arg.split("|")
-        try:
-            task_id = int(parts[0])
-            pr = parts[1] if len(parts) > 1 else "normal"
-            t = find_task(task_id)
-            if t:
-                t["priority"] = pr
-                write_user_tasks(data)
-                await query.edit_message_text(f"Приоритет обновлён: #{task_id} -> {pr}")
-        except Exception:
-            pass
-        return
 
-    # Set due - ask date
-    if action == "setdue_task":
-        try:
-            task_id = int(arg)
-            context.user_data["set_due_task_id"] = task_id
-            await query.edit_message_text("Отправьте дату в формате YYYY-MM-DD [HH:MM]")
-        except ValueError:
-            pass
-        return
+async def _h_setprio_task(query, context: ContextTypes.DEFAULT_TYPE, arg: str, chat_id: str, tasks: Dict[int, Task]) -> None:
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("low", callback_data=f"setprio|{arg}|low"),
+        InlineKeyboardButton("normal", callback_data=f"setprio|{arg}|normal"),
+        InlineKeyboardButton("high", callback_data=f"setprio|{arg}|high"),
+    ]])
+    await query.edit_message_text("Выберите приоритет:", reply_markup=keyboard)
 
-    # Calendar add
-    if action == "cal_add":
+
+async def _h_setprio(query, context: ContextTypes.DEFAULT_TYPE, arg: str, chat_id: str, tasks: Dict[int, Task]) -> None:
+    parts = arg.split("|")
+    try:
+        task_id = int(parts[0])
+        pr = parts[1] if len(parts) > 1 else "normal"
+        t = tasks.get(task_id)
+        if t:
+            t.priority = pr
+            write_user_tasks()
+            await query.edit_message_text(f"Приоритет обновлён: #{task_id} -> {pr}")
+    except Exception:
+        pass
+
+
+async def _h_cal_add(query, context: ContextTypes.DEFAULT_TYPE, arg: str, chat_id: str, tasks: Dict[int, Task]) -> None:
+    async with _CHAT_LOCKS[chat_id]:
         try:
             task_id = int(arg)
-            t = find_task(task_id)
-            if not t or not t.get("due_iso"):
+            t = tasks.get(task_id)
+            if not t or not t.due_iso:
                 await query.edit_message_text("У задачи нет дедлайна. Установите его сначала.")
                 return
-            creds = get_google_credentials()
+            creds = await get_google_credentials()
             if not creds:
                 await query.edit_message_text("Сначала привяжите Google Calendar.")
                 return
-            service = get_calendar_service(creds)
-            start_dt = datetime.fromisoformat(t["due_iso"])
-            end_dt = start_dt + timedelta(hours=1)
-            event = {"summary": t["text"], "description": f"Задача #{task_id}", "start": {"dateTime": start_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE}, "end": {"dateTime": end_dt.isoformat(), "timeZone": CALENDAR_TIMEZONE}}
-            created = service.events().insert(calendarId="primary", body=event).execute()
-            t["calendar_event_id"] = created.get("id")
-            write_user_tasks(data)
+            created = await calendar_insert(creds, build_task_event(t))
+            t.calendar_event_id = created.get("id")
+            write_user_tasks()
             await query.edit_message_text(f"✅ Событие создано в Google Calendar\n{created.get('htmlLink')}")
         except Exception as e:
             logging.exception("Failed calendar add")
             await query.edit_message_text("Ошибка при добавлении в календарь.")
-        return
 
-    # Calendar edit/delete
-    if action == "cal_edit":
-        keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("Удалить событие", callback_data=f"cal_delete|{arg}")
-        ]])
-        await query.edit_message_text("Выберите действие:", reply_markup=keyboard)
-        return
 
-    if action == "cal_delete":
+async def _h_cal_edit(query, context: ContextTypes.DEFAULT_TYPE, arg: str, chat_id: str, tasks: Dict[int, Task]) -> None:
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("Удалить событие", callback_data=f"cal_delete|{arg}")
+    ]])
+    await query.edit_message_text("Выберите действие:", reply_markup=keyboard)
+
+
+async def _h_cal_delete(query, context: ContextTypes.DEFAULT_TYPE, arg: str, chat_id: str, tasks: Dict[int, Task]) -> None:
+    async with _CHAT_LOCKS[chat_id]:
         try:
             task_id = int(arg)
-            t = find_task(task_id)
-            if not t or not t.get("calendar_event_id"):
+            t = tasks.get(task_id)
+            if not t or not t.calendar_event_id:
                 await query.edit_message_text("У задачи нет связанного события календаря.")
                 return
-            creds = get_google_credentials()
+            creds = await get_google_credentials()
             if not creds:
                 await query.edit_message_text("Сначала привяжите Google Calendar.")
                 return
-            service = get_calendar_service(creds)
-            service.events().delete(calendarId="primary", eventId=t["calendar_event_id"]).execute()
-            t["calendar_event_id"] = None
-            write_user_tasks(data)
+            await calendar_delete(creds, t.calendar_event_id)
+            t.calendar_event_id = None
+            write_user_tasks()
             await query.edit_message_text(f"✅ Событие календаря удалено для задачи #{task_id}")
         except Exception as e:
             logging.exception("Failed calendar delete")
             await query.edit_message_text("Ошибка при удалении события.")
-        return
 
-    # Edit action selection
-    if action == "editact":
-        await handle_edit_action(query, context)
+
+async def _h_editact(query, context: ContextTypes.DEFAULT_TYPE, arg: str, chat_id: str, tasks: Dict[int, Task]) -> None:
+    await handle_edit_action(query, context)
+
+
+CALLBACK_HANDLERS = {
+    "done_task": _h_done_task,
+    "setprio_task": _h_setprio_task,
+    "setprio": _h_setprio,
+    "cal_add": _h_cal_add,
+    "cal_edit": _h_cal_edit,
+    "cal_delete": _h_cal_delete,
+    "editact": _h_editact,
+}
+# Only callbacks on_inline_callback handles; wizard prio|/addcal| presses stay with the conversation
+_CB_PATTERN = re.compile(rf"^({'|'.join(CALLBACK_HANDLERS)})\|")
+
+
+async def on_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    payload = (query.data or "|").split("|", 1)
+    handler = CALLBACK_HANDLERS.get(payload[0])
+    if handler is None:
         return
+    arg = payload[1] if len(payload) > 1 else ""
+    chat_id = str(update.effective_chat.id)
+    await handler(query, context, arg, chat_id, chat_tasks(chat_id))
+
+
+async def on_noop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.answer()
 
 
 # ---------------------------
 # Text message handlers
 # ---------------------------
+_TEXT_ROUTES = {
+    BTN_ADD: add_wizard_start,
+    BTN_LIST: list_tasks,
+    BTN_EDIT: choose_edit_action,
+    BTN_CAL_ADD: choose_task_for_calendar_add,
+    BTN_CAL_EDIT: choose_task_for_calendar_edit,
+    BTN_CAL_AUTH: calendar_auth,
+}
+
+
 async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = (update.message.text or "").strip()
 
-    # Handle due date entry
-    if "set_due_task_id" in context.user_data:
-        task_id = context.user_data.pop("set_due_task_id")
-        due_iso = parse_due_datetime(text.split())
-        if due_iso:
-            data = read_user_tasks()
-            chat_id = str(update.effective_chat.id)
-            tasks = data.get(chat_id, [])
-            for t in tasks:
-                if t.get("id") == task_id:
-                    t["due_iso"] = due_iso
-                    write_user_tasks(data)
-                    await update.message.reply_text(f"Дедлайн установлен для задачи #{task_id}: {due_iso}")
-                    return
-            await update.message.reply_text("Задача не найдена")
-        else:
-            await update.message.reply_text("Неверный формат. Введите YYYY-MM-DD [HH:MM]")
-        return
+    # Handle OAuth code
+    if context.user_data.get('awaiting_oauth_code'):
+        try:
+            flow = context.user_data.get('oauth_flow')
+            if flow:
+                # Получаем токен по коду
+                await asyncio.to_thread(flow.fetch_token, code=text)
+                creds = flow.credentials
+                
+                # Сохраняем токен
+                save_google_token(creds)
+                
+                await update.message.reply_text("✅ Google Calendar успешно привязан!")
+                
+                # Очищаем context
+                context.user_data.pop('oauth_flow', None)
+                context.user_data.pop('awaiting_oauth_code', None)
+                return
+        except Exception as e:
+            logging.exception("Failed to process OAuth code")
+            await update.message.reply_text(
+                "❌ Ошибка при обработке кода. Попробуйте еще раз или используйте команду /menu"
+            )
+            context.user_data.pop('oauth_flow', None)
+            context.user_data.pop('awaiting_oauth_code', None)
+            return
 
     # Handle menu buttons
-    if text == BTN_ADD:
-        await add_wizard_start(update, context)
-        return
-    if text == BTN_LIST:
-        await list_tasks(update, context)
-        return
-    if text == BTN_EDIT:
-        await choose_edit_action(update, context)
-        return
-    if text == BTN_CAL_ADD:
-        await choose_task_for_calendar_add(update, context)
-        return
-    if text == BTN_CAL_EDIT:
-        await choose_task_for_calendar_edit(update, context)
-        return
-    if text == BTN_CAL_AUTH:
-        await calendar_auth(update, context)
+    handler = _TEXT_ROUTES.get(text)
+    if handler:
+        await handler(update, context)
         return
 
     # Fallback
@@ -593,12 +722,33 @@ def build_app() -> Application:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set. See .env.example and README.")
 
     async def post_init(application: Application) -> None:
+        global _HTTP
         await application.bot.set_my_commands([
             BotCommand("start", "Показать меню"),
             BotCommand("menu", "Показать меню"),
         ])
-
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
+        # Keep-alive connections (HTTP/2 multiplexed) are reused across Calendar calls
+        _HTTP = httpx.AsyncClient(http2=True, timeout=20.0)
+
+    async def post_shutdown(application: Application) -> None:
+        await flush_user_tasks()
+        if _HTTP is not None:
+            await _HTTP.aclose()
+
+    # Updates are handled concurrently; per-chat locks keep calendar writes for one chat in order
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        # Handlers share one HTTP/2 pool, large enough that concurrent updates don't queue for it
+        .request(HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE, connect_timeout=10.0, read_timeout=20.0, http_version="2"))
+        # getUpdates holds its single connection open; PTB adds POLL_TIMEOUT to this read timeout
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, read_timeout=10.0))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    app.job_queue.run_repeating(flush_user_tasks, interval=STORAGE_FLUSH_INTERVAL)
 
     # Commands
     app.add_handler(CommandHandler("start", start))
@@ -619,8 +769,18 @@ def build_app() -> Application:
         fallbacks=[],
     ))
 
+    # Set due conversation
+    app.add_handler(ConversationHandler(
+        entry_points=[CallbackQueryHandler(set_due_start, pattern=r"^setdue_task\|")],
+        states={
+            SET_DUE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_due_input)],
+        },
+        fallbacks=[],
+    ))
+
     # Inline callbacks
-    app.add_handler(CallbackQueryHandler(on_inline_callback, pattern=r"^.+"))
+    app.add_handler(CallbackQueryHandler(on_inline_callback, pattern=_CB_PATTERN))
+    app.add_handler(CallbackQueryHandler(on_noop_callback, pattern=r"^noop$"))
 
     # Text messages
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages))
@@ -630,9 +790,10 @@ def build_app() -> Application:
 
 def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-    DATA_FILE.touch(exist_ok=True)
+    load_user_tasks()
     app = build_app()
-    app.run_polling()
+    # Long polling: one getUpdates call stays open for up to 50 s instead of re-polling every 10 s
+    app.run_polling(timeout=POLL_TIMEOUT)
 
 
 if __name__ == "__main__":